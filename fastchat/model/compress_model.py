@@ -0,0 +1,205 @@
+"""
+Write a model with group-wise quantized linear layers to disk, and load it.
+
+The converter reads the checkpoint one shard at a time and only keeps the
+compressed weights in memory. The loader memory-maps the compressed weights
+into CLinear modules, so its peak memory is about the compressed size and it
+does not quantize anything. Without a converted checkpoint,
+load_and_compress_model quantizes the weights of every shard right after
+reading it, so its peak memory is one shard plus the compressed model.
+
+Usage:
+python3 -m fastchat.model.compress_model --model-path ~/model_weights/vicuna-7b --output-path ~/model_weights/vicuna-7b-4bit --num-bits 4
+
+Then load the output path as any other model, e.g.
+python3 -m fastchat.serve.cli --model-path ~/model_weights/vicuna-7b-4bit --device cpu
+"""
+import argparse
+import dataclasses
+import glob
+import json
+import os
+
+from accelerate import init_empty_weights
+from accelerate.utils import set_module_tensor_to_device
+from huggingface_hub import snapshot_download
+from safetensors import safe_open
+from safetensors.torch import load_file, save_file
+import torch
+from torch import nn
+from tqdm import tqdm
+from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer
+
+from fastchat.serve.compression import CLinear, CompressionConfig, compress
+
+
+COMPRESSION_CONFIG_NAME = "compression_config.json"
+WEIGHTS_NAME = "compressed_model.safetensors"
+
+
+def is_compressed_checkpoint(model_path):
+    return os.path.exists(os.path.join(model_path, COMPRESSION_CONFIG_NAME))
+
+
+def init_empty_model(config, torch_dtype=None):
+    """Build a model whose parameters are on the meta device."""
+    with init_empty_weights():
+        return AutoModelForCausalLM.from_config(config, torch_dtype=torch_dtype)
+
+
+def get_linear_names(model):
+    return {name for name, module in model.named_modules()
+            if isinstance(module, nn.Linear)}
+
+
+def iter_state_dict(model_path):
+    """Yield the tensors of a checkpoint, reading one shard at a time."""
+    files = sorted(glob.glob(os.path.join(model_path, "*.safetensors")))
+    if not files:
+        files = sorted(glob.glob(os.path.join(model_path, "pytorch_model*.bin")))
+    for file_path in tqdm(files):
+        if file_path.endswith(".safetensors"):
+            state_dict = load_file(file_path)
+        else:
+            state_dict = torch.load(file_path, map_location="cpu")
+        # Free every tensor as soon as it has been used.
+        while state_dict:
+            yield state_dict.popitem()
+        del state_dict
+
+
+def compress_model(model_path, output_path, compression_config, dtype=torch.float16):
+    if not os.path.exists(model_path):
+        model_path = snapshot_download(repo_id=model_path)
+    config = AutoConfig.from_pretrained(model_path)
+    linear_names = get_linear_names(init_empty_model(config))
+
+    tensors, original_shapes = {}, {}
+    for name, param in iter_state_dict(model_path):
+        if param.is_floating_point():
+            param = param.to(dtype)
+        module_name = name.rsplit(".", 1)[0]
+        if name.endswith(".weight") and module_name in linear_names:
+            packed_data = compress(param, compression_config)
+            tensors[f"{name}.data"] = packed_data[0]
+            tensors[f"{name}.scale"] = packed_data[-2]
+            if not compression_config.symmetric:
+                tensors[f"{name}.mn"] = packed_data[1]
+            original_shapes[name] = list(packed_data[-1])
+        else:
+            tensors[name] = param.contiguous()
+
+    os.makedirs(output_path, exist_ok=True)
+    save_file(tensors, os.path.join(output_path, WEIGHTS_NAME),
+              metadata={"original_shapes": json.dumps(original_shapes)})
+    with open(os.path.join(output_path, COMPRESSION_CONFIG_NAME), "w") as fout:
+        json.dump(dataclasses.asdict(compression_config), fout, indent=2)
+    config.save_pretrained(output_path)
+    tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=False)
+    tokenizer.save_pretrained(output_path)
+
+
+def load_compressed_model(model_path, device, torch_dtype=torch.float16):
+    """Load a model written by compress_model. The weights stay memory-mapped on CPU."""
+    with open(os.path.join(model_path, COMPRESSION_CONFIG_NAME)) as fin:
+        compression_config = CompressionConfig(**json.load(fin))
+    model = init_empty_model(AutoConfig.from_pretrained(model_path), torch_dtype)
+
+    with safe_open(os.path.join(model_path, WEIGHTS_NAME), framework="pt",
+                   device="cpu") as f:
+        original_shapes = json.loads(f.metadata()["original_shapes"])
+        loaded = set()
+        for name, module in list(model.named_modules()):
+            weight_name = f"{name}.weight"
+            if not isinstance(module, nn.Linear) or weight_name not in original_shapes:
+                continue
+            keys = [f"{weight_name}.data", f"{weight_name}.scale"]
+            if not compression_config.symmetric:
+                keys.insert(1, f"{weight_name}.mn")
+            packed_data = [f.get_tensor(keys[0])]
+            # The scales are small, so they are copied in the compute dtype.
+            packed_data += [f.get_tensor(key).to(torch_dtype) for key in keys[1:]]
+            packed_data.append(torch.Size(original_shapes[weight_name]))
+            bias = None
+            if module.bias is not None:
+                keys.append(f"{name}.bias")
+                bias = f.get_tensor(keys[-1]).to(device=device, dtype=torch_dtype)
+            loaded.update(keys)
+
+            parent_name, _, attr_str = name.rpartition(".")
+            setattr(model.get_submodule(parent_name), attr_str,
+                    CLinear(tuple(packed_data), bias, device, compression_config))
+
+        for key in f.keys():
+            if key in loaded:
+                continue
+            value = f.get_tensor(key)
+            if value.is_floating_point():
+                value = value.to(torch_dtype)
+            set_module_tensor_to_device(model, key, device, value=value)
+
+    # Move the buffers that are not in the checkpoint.
+    model.to(device)
+    model.eval()
+    return model
+
+
+def load_and_compress_model(model_path, device, compression_config,
+                            torch_dtype=torch.float16):
+    """Load a huggingface checkpoint and compress its linear layers shard by shard."""
+    if not os.path.exists(model_path):
+        model_path = snapshot_download(repo_id=model_path)
+    model = init_empty_model(AutoConfig.from_pretrained(model_path), torch_dtype)
+    linear_names = get_linear_names(model)
+
+    for name, param in iter_state_dict(model_path):
+        module_name, _, tensor_name = name.rpartition(".")
+        if param.is_floating_point():
+            param = param.to(torch_dtype)
+        if module_name not in linear_names:
+            set_module_tensor_to_device(model, name, device, value=param)
+            continue
+
+        module = model.get_submodule(module_name)
+        if tensor_name == "bias":
+            if isinstance(module, CLinear):
+                module.bias = param.to(device)
+            else:
+                set_module_tensor_to_device(model, name, device, value=param)
+            continue
+
+        bias = module.bias
+        if bias is not None and bias.device.type == "meta":
+            # The bias is in a later shard.
+            bias = None
+        parent_name, _, attr_str = module_name.rpartition(".")
+        setattr(model.get_submodule(parent_name), attr_str,
+                CLinear(param, bias, device, compression_config))
+        del param
+
+    missing = [name for name, param in model.named_parameters()
+               if param.device.type == "meta"]
+    if missing:
+        raise ValueError(f"Missing weights in {model_path}: {missing}")
+    # Move the buffers that are not in the checkpoint.
+    model.to(device)
+    model.eval()
+    return model
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-path", type=str, required=True)
+    parser.add_argument("--output-path", type=str, required=True)
+    parser.add_argument("--num-bits", type=int, choices=[2, 3, 4, 8], default=8)
+    parser.add_argument("--group-size", type=int, default=256)
+    parser.add_argument("--asymmetric", action="store_true")
+    parser.add_argument("--dtype", type=str, default="float16",
+        choices=["float32", "float16", "bfloat16"],
+        help="The dtype of the uncompressed tensors and the scales.")
+    args = parser.parse_args()
+
+    compress_model(args.model_path, args.output_path,
+        CompressionConfig(num_bits=args.num_bits, group_size=args.group_size,
+                          group_dim=1, symmetric=not args.asymmetric),
+        getattr(torch, args.dtype))
@@ -0,0 +1,101 @@
+"""
+Admission control of a model worker by the KV cache a request needs.
+
+A request is charged its prompt tokens plus `max_new_tokens`, which bounds
+the size of its KV cache. Requests are admitted in arrival order while the
+charged tokens of all running requests fit the budget, so a few long
+requests and many short ones take the same memory. A request that does not
+fit even into an empty budget is rejected instead of queued.
+"""
+import asyncio
+import collections
+from typing import Optional
+
+
+def kv_bytes_per_token(model):
+    """The bytes of the keys and values of one token in all layers."""
+    config = model.config
+    num_layers = getattr(config, "num_hidden_layers", None) or config.num_layers
+    element_size = next(model.parameters()).element_size()
+    return 2 * num_layers * config.hidden_size * element_size
+
+
+class TokenBudget:
+    """Admit requests in FIFO order while their tokens fit a budget.
+
+    `max_tokens=None` disables the token limit, and at most `max_requests`
+    requests run at a time either way. All methods must be called from the
+    event loop.
+    """
+
+    def __init__(self, max_tokens: Optional[int], max_requests: int,
+                 unit_tokens: int = 2048):
+        self.max_tokens = max_tokens
+        self.max_requests = max_requests
+        # The number of tokens that count as one request in `load`.
+        self.unit_tokens = unit_tokens
+        self.running_tokens = 0
+        self.num_running = 0
+        self.queued_tokens = 0
+        self.waiters = collections.deque()  # (tokens, future)
+
+    def fits(self, tokens: int):
+        """Whether a request can ever be admitted."""
+        return self.max_tokens is None or tokens <= self.max_tokens
+
+    def can_admit(self, tokens: int):
+        return (self.num_running < self.max_requests and
+                (self.max_tokens is None or
+                 self.running_tokens + tokens <= self.max_tokens))
+
+    def num_requests(self):
+        return self.num_running + len(self.waiters)
+
+    def load(self):
+        """The running and queued tokens, in units of `unit_tokens`."""
+        return round((self.running_tokens + self.queued_tokens) / self.unit_tokens, 2)
+
+    async def acquire(self, tokens: int):
+        if not self.waiters and self.can_admit(tokens):
+            self.admit(tokens)
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append((tokens, future))
+        self.queued_tokens += tokens
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.cancelled():
+                if (tokens, future) in self.waiters:
+                    self.waiters.remove((tokens, future))
+                    self.queued_tokens -= tokens
+                self.wake_up()
+            else:
+                # Admitted right before the cancellation.
+                self.release(tokens)
+            raise
+
+    def admit(self, tokens: int):
+        self.running_tokens += tokens
+        self.num_running += 1
+
+    def release(self, tokens: int):
+        self.running_tokens -= tokens
+        self.num_running -= 1
+        self.wake_up()
+
+    def wake_up(self):
+        while self.waiters and self.can_admit(self.waiters[0][0]):
+            tokens, future = self.waiters.popleft()
+            self.queued_tokens -= tokens
+            if future.cancelled():
+                continue
+            self.admit(tokens)
+            future.set_result(None)
+
+    def __repr__(self):
+        return (f"TokenBudget(running={self.num_running}, "
+                f"running_tokens={self.running_tokens}, "
+                f"queued={len(self.waiters)}, queued_tokens={self.queued_tokens}, "
+                f"max_tokens={self.max_tokens})")
@@ -0,0 +1,406 @@
+"""
+Continuous (iteration-level) batching for Hugging Face models.
+
+All active requests share one batched forward pass per decode step.
+New requests are prefilled and join the batch between two steps, and
+finished requests leave it, so the batch never waits for its slowest member.
+Long prompts can be prefilled in chunks, one chunk between two decode steps,
+so that a long prefill does not stall the streams of the running requests.
+A request for several samples (`n`, `best_of`) is prefilled once and then
+forked into one row per sample.
+"""
+import asyncio
+import dataclasses
+import inspect
+import threading
+from typing import List, Optional
+
+import torch
+
+from fastchat.serve.detokenizer import IncrementalDetokenizer
+from fastchat.serve.parallel_sampling import expand_kv, get_num_samples, select_best
+from fastchat.serve.prefix_cache import lookup_prefix
+from fastchat.serve.sampling import LogitsProcessor, SamplingParams
+from fastchat.serve.stop_matcher import StopMatcher
+
+
+class AsyncOutputs:
+    """Hand the outputs of a request from the engine thread to the event loop."""
+
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+
+    def put(self, item):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, item)
+
+    async def get(self):
+        return await self.queue.get()
+
+
+@dataclasses.dataclass
+class BatchedRequest:
+    """The state of one request inside the batch."""
+    params: dict
+    session_id: Optional[str]
+    input_ids: List[int]
+    detokenizer: IncrementalDetokenizer
+    echo: bool
+    sampling_params: SamplingParams
+    max_new_tokens: int
+    stop_matcher: StopMatcher
+    outputs: AsyncOutputs
+    num_generated: int = 0
+    num_yielded: int = 0
+    aborted: bool = False
+    # The prompt tokens in past_key_values while the prompt is prefilled.
+    num_prefilled: int = 0
+    past_key_values: Optional[tuple] = None
+    # The sample of a request with several samples. The other samples are
+    # forked from the first one after its prefill.
+    index: Optional[int] = None
+    forks: List["BatchedRequest"] = dataclasses.field(default_factory=list)
+    # The sum of the log probabilities of the sampled tokens, for best_of.
+    logprob: Optional[float] = None
+
+
+class ContinuousBatchingEngine:
+    """Run the decode loop of all requests in one background thread.
+
+    The KV cache of the running batch is kept as one left-padded tensor per
+    layer. A joining request is padded and concatenated to it, a leaving
+    request is dropped with index_select, and columns that only contain
+    padding are trimmed away.
+    """
+
+    def __init__(self, model, tokenizer, device, context_len=2048,
+                 stream_interval=2, max_batch_size=8, conv_kv_cache=None,
+                 system_prompt_cache=None, prefill_chunk_size=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self.context_len = context_len
+        self.stream_interval = stream_interval
+        self.max_batch_size = max_batch_size
+        self.conv_kv_cache = conv_kv_cache
+        self.system_prompt_cache = system_prompt_cache
+        # The maximum number of prompt tokens to prefill between two decode
+        # steps. None prefills every new prompt at once.
+        self.prefill_chunk_size = prefill_chunk_size
+        self.accepts_position_ids = (
+            "position_ids" in inspect.signature(model.forward).parameters)
+
+        self.waiting: List[BatchedRequest] = []
+        self.prefilling: List[BatchedRequest] = []
+        self.running: List[BatchedRequest] = []
+        self.cond = threading.Condition()
+
+        # Batch state: per-layer (key, value) of shape
+        # [batch, heads, seq_len, head_dim], an attention mask of shape
+        # [batch, seq_len], and the last sampled token of each row.
+        self.past_key_values = None
+        self.attention_mask = None
+        self.last_tokens = None
+
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    async def generate_stream(self, params, input_ids=None):
+        """Submit a request and yield its outputs like `generate_stream`.
+
+        It must be iterated on an event loop. Pass the token ids of the prompt
+        if they are known, so that it is not tokenized on the event loop.
+        """
+        prompt = params["prompt"]
+        max_new_tokens = int(params.get("max_new_tokens", 256))
+        n, best_of = get_num_samples(params)
+        streaming = best_of == n
+
+        if input_ids is None:
+            input_ids = self.tokenizer(prompt).input_ids
+        max_src_len = self.context_len - max_new_tokens - 8
+        outputs = AsyncOutputs()
+        reqs = [BatchedRequest(
+            params=params,
+            session_id=params.get("session_id", None) if best_of == 1 else None,
+            input_ids=input_ids[-max_src_len:],
+            detokenizer=IncrementalDetokenizer(self.tokenizer, input_ids),
+            echo=params.get("echo", True),
+            sampling_params=SamplingParams.from_dict(params),
+            max_new_tokens=max_new_tokens,
+            stop_matcher=StopMatcher.from_params(params, self.tokenizer),
+            outputs=outputs,
+            index=i if best_of > 1 else None,
+            logprob=None if streaming else 0.0,
+        ) for i in range(best_of)]
+        reqs[0].forks = reqs[1:]
+
+        with self.cond:
+            self.waiting.append(reqs[0])
+            self.cond.notify()
+
+        final_outputs = [None] * best_of
+        num_finished = 0
+        try:
+            while num_finished < best_of:
+                item = await outputs.get()
+                if item is None:
+                    num_finished += 1
+                elif isinstance(item, Exception):
+                    raise item
+                elif streaming:
+                    yield item
+                elif item["finish_reason"] is not None:
+                    req = reqs[item["index"]]
+                    final_outputs[req.index] = dict(item, token_ids=req.detokenizer.output_ids)
+        finally:
+            # The client may disconnect before the request finishes.
+            for req in reqs:
+                req.aborted = True
+
+        if not streaming:
+            for output in select_best(final_outputs, [req.logprob for req in reqs], n):
+                yield output
+
+    def get_num_active_requests(self):
+        with self.cond:
+            return len(self.waiting) + len(self.prefilling) + len(self.running)
+
+    def loop(self):
+        while True:
+            with self.cond:
+                while not self.waiting and not self.prefilling and not self.running:
+                    self.cond.wait()
+                # A request takes one row per sample. A request with more
+                # samples than the batch size runs alone.
+                num_free = self.max_batch_size - len(self.running) - sum(
+                    1 + len(req.forks) for req in self.prefilling)
+                while self.waiting and (1 + len(self.waiting[0].forks) <= num_free or
+                                        not self.running and not self.prefilling):
+                    req = self.waiting.pop(0)
+                    num_free -= 1 + len(req.forks)
+                    self.prefilling.append(req)
+
+            try:
+                budget = self.prefill_chunk_size
+                for req in list(self.prefilling):
+                    num_tokens = self.prefill(req, budget)
+                    if budget is not None:
+                        budget -= num_tokens
+                        if budget <= 0:
+                            break
+                if self.running:
+                    self.decode_step()
+            except Exception as e:
+                # Fail every request in the batch and start over.
+                with self.cond:
+                    reqs = self.running + self.prefilling
+                    self.running = []
+                    self.prefilling = []
+                for req in reqs:
+                    req.past_key_values = None
+                self.past_key_values = None
+                self.attention_mask = None
+                self.last_tokens = None
+                for req in reqs:
+                    req.outputs.put(e)
+                if self.device == "cuda":
+                    torch.cuda.empty_cache()
+
+    @torch.inference_mode()
+    def prefill(self, req: BatchedRequest, max_tokens: Optional[int] = None):
+        """Run up to `max_tokens` more prompt tokens of a new request.
+
+        Once the whole prompt is done, the request is merged into the batch.
+        Return the number of tokens run.
+        """
+        if req.aborted:
+            with self.cond:
+                self.prefilling.remove(req)
+            req.past_key_values = None
+            return 0
+        if req.num_prefilled == 0 and req.past_key_values is None:
+            req.num_prefilled, req.past_key_values = lookup_prefix(
+                req.input_ids, req.session_id,
+                self.conv_kv_cache, self.system_prompt_cache)
+
+        start = req.num_prefilled
+        end = len(req.input_ids)
+        if max_tokens is not None:
+            end = min(end, start + max_tokens)
+        out = self.model(
+            torch.as_tensor([req.input_ids[start:end]], device=self.device),
+            use_cache=True, past_key_values=req.past_key_values)
+        req.num_prefilled = end
+        req.past_key_values = out.past_key_values
+        if end < len(req.input_ids):
+            return end - start
+
+        with self.cond:
+            self.prefilling.remove(req)
+        past_key_values, req.past_key_values = req.past_key_values, None
+        # Fork the prompt into one row per sample.
+        group = [req] + req.forks
+        logits = out.logits[:, -1, :]
+        if req.forks:
+            logits = logits.repeat(len(group), 1)
+        tokens = self.sample(logits, group)
+
+        joining, joining_tokens = [], []
+        for r, token in zip(group, tokens):
+            if self.process_token(r, token):
+                self.retain_kv(r, past_key_values)
+            else:
+                joining.append(r)
+                joining_tokens.append(token)
+        if not joining:
+            return end - start
+
+        with self.cond:
+            self.running.extend(joining)
+        if len(joining) > 1:
+            past_key_values = expand_kv(past_key_values, len(joining))
+        attention_mask = torch.ones(
+            (len(joining), len(req.input_ids)), dtype=torch.long, device=self.device)
+        last_tokens = torch.as_tensor(joining_tokens, device=self.device).unsqueeze(1)
+        if self.past_key_values is None:
+            self.past_key_values = past_key_values
+            self.attention_mask = attention_mask
+            self.last_tokens = last_tokens
+            return end - start
+
+        # Left-pad the shorter side so that both have the same length.
+        old_len = self.attention_mask.shape[1]
+        new_len = attention_mask.shape[1]
+        seq_len = max(old_len, new_len)
+        self.past_key_values = tuple(
+            tuple(torch.cat([pad_left(a, seq_len - old_len, 2),
+                             pad_left(b, seq_len - new_len, 2)], dim=0)
+                  for a, b in zip(old_layer, new_layer))
+            for old_layer, new_layer in zip(self.past_key_values, past_key_values))
+        self.attention_mask = torch.cat([
+            pad_left(self.attention_mask, seq_len - old_len, 1),
+            pad_left(attention_mask, seq_len - new_len, 1)], dim=0)
+        self.last_tokens = torch.cat([self.last_tokens, last_tokens], dim=0)
+        return end - start
+
+    @torch.inference_mode()
+    def decode_step(self):
+        """Run one batched decode step for all running requests."""
+        attention_mask = torch.cat([
+            self.attention_mask,
+            self.attention_mask.new_ones((self.attention_mask.shape[0], 1))], dim=1)
+        kwargs = {}
+        if self.accepts_position_ids:
+            kwargs["position_ids"] = self.attention_mask.sum(dim=1, keepdim=True)
+        out = self.model(input_ids=self.last_tokens,
+                         past_key_values=self.past_key_values,
+                         attention_mask=attention_mask,
+                         use_cache=True, **kwargs)
+        tokens = self.sample(out.logits[:, -1, :], self.running)
+
+        keep = []
+        for i, (req, token) in enumerate(zip(self.running, tokens)):
+            if not self.process_token(req, token):
+                keep.append(i)
+            elif self.conv_kv_cache is not None and req.session_id is not None:
+                # Copy the valid (right-aligned) part of this row out of the batch.
+                length = int(attention_mask[i].sum())
+                self.retain_kv(req, tuple(
+                    tuple(x[i:i + 1, :, -length:].clone() for x in layer)
+                    for layer in out.past_key_values))
+
+        self.past_key_values = out.past_key_values
+        self.attention_mask = attention_mask
+        self.last_tokens = torch.as_tensor(tokens, device=self.device).unsqueeze(1)
+        if len(keep) < len(self.running):
+            self.remove_rows(keep)
+
+    def remove_rows(self, keep: List[int]):
+        with self.cond:
+            self.running = [self.running[i] for i in keep]
+        if not keep:
+            self.past_key_values = None
+            self.attention_mask = None
+            self.last_tokens = None
+            return
+
+        index = torch.as_tensor(keep, device=self.device)
+        attention_mask = self.attention_mask.index_select(0, index)
+        # Drop the leading columns that are padding for every remaining row.
+        start = int((attention_mask.sum(dim=0) == 0).long().cumprod(dim=0).sum())
+        self.attention_mask = attention_mask[:, start:]
+        self.past_key_values = tuple(
+            tuple(x.index_select(0, index)[:, :, start:] for x in layer)
+            for layer in self.past_key_values)
+        self.last_tokens = self.last_tokens.index_select(0, index)
+
+    def retain_kv(self, req: BatchedRequest, past_key_values):
+        """Keep the KV cache of a finished request for the next turn."""
+        if self.conv_kv_cache is None or req.session_id is None:
+            return
+        # The last sampled token has not been fed to the model.
+        self.conv_kv_cache.put(req.session_id,
+            req.input_ids + req.detokenizer.output_ids[:-1], past_key_values)
+
+    def sample(self, logits, reqs: List[BatchedRequest]):
+        """Sample one token per row of `logits` with the params of each request."""
+        if self.device == "mps":
+            # Switch to CPU by avoiding some bugs in mps backend.
+            logits = logits.float().to("cpu")
+
+        if any(req.logprob is not None for req in reqs):
+            logprobs = torch.log_softmax(logits.float(), dim=-1)
+        logits_processor = LogitsProcessor([req.sampling_params for req in reqs])
+        tokens = logits_processor.sample(logits, [req.input_ids for req in reqs],
+            [req.detokenizer.output_ids for req in reqs])
+        for i, (req, token) in enumerate(zip(reqs, tokens)):
+            if req.logprob is not None:
+                req.logprob += logprobs[i, token].item()
+        return tokens
+
+    def process_token(self, req: BatchedRequest, token: int):
+        """Record a new token, stream the output and return whether it is done."""
+        if req.aborted:
+            return True
+
+        stop_pos = req.stop_matcher.update(token, req.detokenizer.add_tokens([token]))
+        i = req.num_generated
+        req.num_generated += 1
+        total_len = len(req.input_ids) + req.num_generated
+        if stop_pos is not None:
+            finish_reason = "stop"
+        elif req.num_generated >= req.max_new_tokens or total_len >= self.context_len:
+            finish_reason = "length"
+        else:
+            finish_reason = None
+
+        if i % self.stream_interval == 0 or finish_reason is not None:
+            output = req.detokenizer.output[:stop_pos]
+            ret = {
+                "text": req.detokenizer.prompt_text + output if req.echo else output,
+                "token_ids": req.detokenizer.output_ids[req.num_yielded:],
+                "usage": {
+                    "prompt_tokens": len(req.input_ids),
+                    "completion_tokens": req.num_generated,
+                    "total_tokens": total_len,
+                },
+                "finish_reason": finish_reason,
+            }
+            if req.index is not None:
+                ret["index"] = req.index
+            req.outputs.put(ret)
+            req.num_yielded = req.num_generated
+
+        finished = finish_reason is not None
+        if finished:
+            req.outputs.put(None)
+        return finished
+
+
+def pad_left(x, pad_len, dim):
+    if pad_len == 0:
+        return x
+    pad_shape = list(x.shape)
+    pad_shape[dim] = pad_len
+    return torch.cat([x.new_zeros(pad_shape), x], dim=dim)
@@ -0,0 +1,70 @@
+"""Benchmarking script to compare the forward paths of compressed linear layers."""
+import argparse
+import time
+
+import torch
+from torch.nn import functional as F
+
+from fastchat.serve.compression import (CompressionConfig,
+    compress, decompress, compressed_linear)
+
+
+def decompress_linear(input, packed_data, bias, config):
+    """The old path, which decompresses the whole weight on every call."""
+    return F.linear(input, decompress(packed_data, config), bias)
+
+
+def benchmark(func, *inputs):
+    for _ in range(args.warmup):
+        func(*inputs)
+    tik = time.time()
+    for _ in range(args.repeat):
+        output = func(*inputs)
+    return output, (time.time() - tik) / args.repeat
+
+
+def main():
+    dtype = getattr(torch, args.dtype)
+    config = CompressionConfig(num_bits=args.num_bits, group_size=args.group_size,
+                               group_dim=1, symmetric=not args.asymmetric)
+    print(f"device: {args.device}, dtype: {args.dtype}, threads: {torch.get_num_threads()}, "
+          f"config: {config}")
+    print(f"{'shape':>12} {'MB':>6} {'tokens':>6} {'dense':>9} {'decompress':>11} "
+          f"{'grouped':>9} {'speedup':>8} {'rel_err':>8}")
+    for shape in args.shapes:
+        out_features, in_features = (int(x) for x in shape.split("x"))
+        weight = torch.randn(out_features, in_features, device=args.device,
+                             dtype=dtype) * 0.02
+        packed_data = compress(weight, config)
+        megabytes = sum(x.numel() * x.element_size() for x in packed_data
+                        if isinstance(x, torch.Tensor)) / 2 ** 20
+        for num_tokens in args.num_tokens:
+            x = torch.randn(num_tokens, in_features, device=args.device, dtype=dtype)
+            ref, dense_time = benchmark(F.linear, x, weight, None)
+            _, old_time = benchmark(decompress_linear, x, packed_data, None, config)
+            out, new_time = benchmark(compressed_linear, x, packed_data, None, config)
+            rel_err = ((out.float() - ref.float()).norm() / ref.float().norm()).item()
+            print(f"{shape:>12} {megabytes:>6.1f} {num_tokens:>6} {dense_time * 1e3:>7.2f}ms "
+                  f"{old_time * 1e3:>9.2f}ms {new_time * 1e3:>7.2f}ms "
+                  f"{old_time / new_time:>7.2f}x {rel_err:>8.4f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, choices=["cpu", "cuda", "mps"], default="cpu")
+    parser.add_argument("--dtype", type=str, default="float32",
+        choices=["float32", "float16", "bfloat16"])
+    # The linear layers of LLaMA-7B.
+    parser.add_argument("--shapes", type=str, nargs="+",
+        default=["4096x4096", "11008x4096", "4096x11008"],
+        help="Weight shapes as out_featuresxin_features.")
+    parser.add_argument("--num-tokens", type=int, nargs="+", default=[1, 16, 128],
+        help="Batch sizes to benchmark. 1 is a decode step.")
+    parser.add_argument("--num-bits", type=int, choices=[2, 3, 4, 8], default=8)
+    parser.add_argument("--group-size", type=int, default=256)
+    parser.add_argument("--asymmetric", action="store_true")
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    main()
@@ -0,0 +1,182 @@
+"""
+Benchmark the accuracy, speed and memory of CompressionConfig choices.
+
+For every combination of bits, group size and symmetric/asymmetric, a copy
+of a model is compressed with compress_module and compared with the
+uncompressed model. By default the model is a tiny randomly initialized
+LLaMA on CPU and the text is tokenized as UTF-8 bytes, so the suite runs
+anywhere without downloads. The results are written to a JSON file.
+
+Usage:
+python3 -m fastchat.serve.benchmark_compression_suite --output compression.json
+"""
+import argparse
+import copy
+import dataclasses
+import json
+import time
+
+import torch
+from torch import nn
+from torch.nn import functional as F
+from transformers import AutoModelForCausalLM, AutoTokenizer, LlamaConfig, LlamaForCausalLM
+
+from fastchat.serve.compression import CLinear, CompressionConfig, compress_module, decompress
+
+
+def rss_mb():
+    with open("/proc/self/statm") as fin:
+        return int(fin.read().split()[1]) * 4096 / 2 ** 20
+
+
+def model_nbytes(model):
+    tensors = list(model.parameters()) + list(model.buffers())
+    for module in model.modules():
+        if isinstance(module, CLinear):
+            tensors.extend(x for x in module.weight if isinstance(x, torch.Tensor))
+    return sum(x.numel() * x.element_size() for x in tensors)
+
+
+def load_tokens(data_path, tokenizer, max_tokens):
+    texts = []
+    with open(data_path) as fin:
+        if data_path.endswith(".jsonl"):
+            texts = [json.loads(line)["text"] for line in fin]
+        else:
+            texts = [fin.read()]
+    text = "\n\n".join(texts)
+    if tokenizer is None:
+        # Byte-level tokens.
+        return list(text.encode()[:max_tokens])
+    return tokenizer(text).input_ids[:max_tokens]
+
+
+@torch.inference_mode()
+def evaluate(model, tokens):
+    """Return the perplexity and the logits of every window of tokens."""
+    nll, count, all_logits = 0.0, 0, []
+    for start in range(0, len(tokens) - 1, args.seq_len):
+        window = tokens[start:start + args.seq_len + 1]
+        logits = model(torch.as_tensor([window[:-1]])).logits[0].float()
+        nll += F.cross_entropy(logits, torch.as_tensor(window[1:]), reduction="sum").item()
+        count += len(window) - 1
+        all_logits.append(logits)
+    return float(torch.exp(torch.tensor(nll / count))), torch.cat(all_logits)
+
+
+@torch.inference_mode()
+def measure_latency(model, vocab_size):
+    input_ids = torch.randint(0, vocab_size, (1, args.seq_len))
+    times = {"prefill_ms": [], "decode_ms": []}
+    for _ in range(args.repeat):
+        tik = time.time()
+        out = model(input_ids, use_cache=True)
+        times["prefill_ms"].append((time.time() - tik) * 1e3)
+        tik = time.time()
+        model(input_ids[:, -1:], use_cache=True, past_key_values=out.past_key_values)
+        times["decode_ms"].append((time.time() - tik) * 1e3)
+    return {k: sorted(v)[len(v) // 2] for k, v in times.items()}
+
+
+def layer_errors(model, compressed_model):
+    errors = {}
+    compressed_modules = dict(compressed_model.named_modules())
+    for name, module in model.named_modules():
+        if isinstance(module, nn.Linear):
+            clinear = compressed_modules[name]
+            weight = decompress(clinear.weight, clinear.config)
+            errors[name] = ((weight - module.weight).norm() / module.weight.norm()).item()
+    return errors
+
+
+def main():
+    torch.manual_seed(args.seed)
+    if args.model_path:
+        tokenizer = AutoTokenizer.from_pretrained(args.model_path, use_fast=False)
+        model = AutoModelForCausalLM.from_pretrained(args.model_path)
+        vocab_size = model.config.vocab_size
+    else:
+        tokenizer = None
+        vocab_size = 256
+        model = LlamaForCausalLM(LlamaConfig(
+            vocab_size=vocab_size, hidden_size=args.hidden_size,
+            intermediate_size=args.intermediate_size,
+            num_hidden_layers=args.num_layers,
+            num_attention_heads=args.num_heads))
+    model.eval()
+    tokens = load_tokens(args.data_path, tokenizer, args.max_tokens)
+
+    base_ppl, base_logits = evaluate(model, tokens)
+    baseline = {
+        "perplexity": base_ppl,
+        "model_bytes": model_nbytes(model),
+        "rss_mb": rss_mb(),
+        **measure_latency(model, vocab_size),
+    }
+    print(f"baseline: {baseline}")
+
+    results = []
+    for num_bits in args.num_bits:
+        for group_size in args.group_sizes:
+            for symmetric in args.symmetric:
+                config = CompressionConfig(num_bits=num_bits, group_size=group_size,
+                                           group_dim=1, symmetric=symmetric)
+                compressed_model = copy.deepcopy(model)
+                compress_module(compressed_model, "cpu", config)
+
+                errors = layer_errors(model, compressed_model)
+                ppl, logits = evaluate(compressed_model, tokens)
+                result = {
+                    "config": dataclasses.asdict(config),
+                    "mean_layer_error": sum(errors.values()) / len(errors),
+                    "max_layer_error": max(errors.values()),
+                    "perplexity": ppl,
+                    "perplexity_delta": ppl - base_ppl,
+                    "logits_rel_error": ((logits - base_logits).norm() /
+                                         base_logits.norm()).item(),
+                    "model_bytes": model_nbytes(compressed_model),
+                    "rss_mb": rss_mb(),
+                    **measure_latency(compressed_model, vocab_size),
+                    "layer_errors": errors,
+                }
+                results.append(result)
+                print(f"bits={num_bits} group_size={group_size} symmetric={symmetric}: "
+                      f"layer_err={result['mean_layer_error']:.4f} "
+                      f"ppl={ppl:.3f} ({result['perplexity_delta']:+.3f}) "
+                      f"bytes={result['model_bytes'] / baseline['model_bytes']:.2f}x "
+                      f"prefill={result['prefill_ms']:.1f}ms decode={result['decode_ms']:.1f}ms")
+                del compressed_model
+
+    with open(args.output, "w") as fout:
+        json.dump({
+            "args": vars(args),
+            "num_tokens": len(tokens),
+            "baseline": baseline,
+            "results": results,
+        }, fout, indent=2)
+    print(f"Results are written to {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-path", type=str, default=None,
+        help="A huggingface model. By default, a tiny random LLaMA is used.")
+    parser.add_argument("--hidden-size", type=int, default=256)
+    parser.add_argument("--intermediate-size", type=int, default=688)
+    parser.add_argument("--num-layers", type=int, default=4)
+    parser.add_argument("--num-heads", type=int, default=4)
+    parser.add_argument("--data-path", type=str,
+        default="fastchat/eval/table/answer/answer_gpt35.jsonl",
+        help="A text file, or a jsonl file with a \"text\" field per line.")
+    parser.add_argument("--max-tokens", type=int, default=4096)
+    parser.add_argument("--seq-len", type=int, default=256)
+    parser.add_argument("--num-bits", type=int, nargs="+", default=[8, 4, 3, 2])
+    parser.add_argument("--group-sizes", type=int, nargs="+", default=[32, 128])
+    parser.add_argument("--symmetric", type=lambda x: x.lower() == "true",
+        nargs="+", default=[True, False])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default="compression_benchmark.json")
+    args = parser.parse_args()
+
+    main()
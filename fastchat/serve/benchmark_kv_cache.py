@@ -0,0 +1,78 @@
+"""Benchmarking script to compare the memory and perplexity of fp16 and int8 KV caches."""
+import argparse
+import json
+import math
+
+import torch
+from torch.nn import functional as F
+
+from fastchat.serve.inference import load_model
+from fastchat.serve.kv_cache import StaticKVCache, supports_static_kv_cache
+
+
+@torch.inference_mode()
+def compute_nll(model, input_ids, device, quantized):
+    """Feed the text in chunks through a static cache and sum the NLL of every token."""
+    cache = StaticKVCache.from_model(model, len(input_ids), quantized=quantized)
+    nll = 0.0
+    for start in range(0, len(input_ids) - 1, args.chunk_size):
+        chunk = input_ids[start:start + args.chunk_size]
+        targets = input_ids[start + 1:start + 1 + len(chunk)]
+        logits = model(torch.as_tensor([chunk], device=device),
+                       use_cache=True, past_key_values=cache).logits[0]
+        logits = logits[:len(targets)].float()
+        nll += F.cross_entropy(logits, torch.as_tensor(targets, device=device),
+                               reduction="sum").item()
+    return nll, cache.nbytes() / len(input_ids)
+
+
+def main():
+    model, tokenizer = load_model(args.model_path, args.device, args.num_gpus,
+                                  load_8bit=args.load_8bit)
+    if not supports_static_kv_cache(model):
+        raise ValueError("The static KV cache only supports LLaMA models on cpu and cuda.")
+
+    texts = []
+    with open(args.data_path) as fin:
+        for line in fin:
+            texts.append(json.loads(line)["text"])
+    texts = texts[:args.num_samples]
+
+    total_nll = {False: 0.0, True: 0.0}
+    bytes_per_token = {}
+    num_tokens = 0
+    for text in texts:
+        input_ids = tokenizer(text).input_ids[:args.max_len]
+        for quantized in (False, True):
+            nll, bytes_per_token[quantized] = compute_nll(
+                model, input_ids, args.device, quantized)
+            total_nll[quantized] += nll
+        num_tokens += len(input_ids) - 1
+
+    ppl = {k: math.exp(v / num_tokens) for k, v in total_nll.items()}
+    print(f"texts: {len(texts)}, tokens: {num_tokens}")
+    print(f"KV cache per token: {bytes_per_token[False] / 1024:.1f} KiB -> "
+          f"{bytes_per_token[True] / 1024:.1f} KiB "
+          f"({1 - bytes_per_token[True] / bytes_per_token[False]:.1%} saved)")
+    print(f"perplexity: {ppl[False]:.4f} -> {ppl[True]:.4f} "
+          f"(delta {ppl[True] - ppl[False]:+.4f}, {ppl[True] / ppl[False] - 1:+.2%})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-path", type=str, required=True,
+        help="A LLaMA model, the only one with a static KV cache.")
+    parser.add_argument("--device", type=str, choices=["cpu", "cuda"], default="cuda")
+    parser.add_argument("--num-gpus", type=str, default="1")
+    parser.add_argument("--load-8bit", action="store_true")
+    parser.add_argument("--data-path", type=str,
+        default="fastchat/eval/table/answer/answer_gpt35.jsonl",
+        help="A jsonl file with a \"text\" field per line.")
+    parser.add_argument("--num-samples", type=int, default=40)
+    parser.add_argument("--max-len", type=int, default=512)
+    parser.add_argument("--chunk-size", type=int, default=16,
+        help="The number of tokens per forward pass. Every chunk attends to "
+             "the cached keys and values of all previous chunks.")
+    args = parser.parse_args()
+
+    main()
@@ -0,0 +1,108 @@
+"""Benchmarking script to measure the time per decode step of the sampler.
+
+For a batch of requests, it compares sampling one row at a time, as
+generate_stream used to do, and with the huggingface logits warpers, with
+one batched LogitsProcessor.
+"""
+import argparse
+import time
+
+import torch
+from transformers.generation.logits_process import (LogitsProcessorList,
+    RepetitionPenaltyLogitsProcessor, TemperatureLogitsWarper,
+    TopKLogitsWarper, TopPLogitsWarper)
+
+from fastchat.serve.sampling import LogitsProcessor, SamplingParams
+
+
+SETTINGS = {
+    "greedy": SamplingParams(temperature=0.0),
+    "temperature": SamplingParams(temperature=0.7),
+    "top_k+top_p": SamplingParams(temperature=0.7, top_k=40, top_p=0.9),
+    "penalties": SamplingParams(temperature=0.7, top_k=40, top_p=0.9,
+                                repetition_penalty=1.1, frequency_penalty=0.2),
+}
+
+
+def sample_per_row(logits, params, prompt_ids, output_ids):
+    """The old sampler of generate_stream, which only supports temperature."""
+    tokens = []
+    for row in logits:
+        if params.greedy:
+            tokens.append(int(torch.argmax(row)))
+        else:
+            probs = torch.softmax(row / params.temperature, dim=-1)
+            tokens.append(int(torch.multinomial(probs, num_samples=1)))
+    return tokens
+
+
+def sample_hf(logits, params, prompt_ids, output_ids):
+    """One row at a time with the huggingface logits processors."""
+    processors = LogitsProcessorList()
+    if params.repetition_penalty != 1.0:
+        processors.append(RepetitionPenaltyLogitsProcessor(params.repetition_penalty))
+    if not params.greedy:
+        processors.append(TemperatureLogitsWarper(params.temperature))
+    if params.top_k > 0:
+        processors.append(TopKLogitsWarper(params.top_k))
+    if params.top_p < 1.0:
+        processors.append(TopPLogitsWarper(params.top_p))
+    tokens = []
+    for i, row in enumerate(logits):
+        input_ids = torch.as_tensor([prompt_ids[i] + output_ids[i]], device=logits.device)
+        row = processors(input_ids, row.unsqueeze(0))
+        if params.greedy:
+            tokens.append(int(torch.argmax(row)))
+        else:
+            tokens.append(int(torch.multinomial(torch.softmax(row, dim=-1), 1)))
+    return tokens
+
+
+def sample_batched(logits, params, prompt_ids, output_ids):
+    return LogitsProcessor([params] * len(logits)).sample(logits, prompt_ids, output_ids)
+
+
+def benchmark(func, *inputs):
+    for _ in range(args.warmup):
+        func(*inputs)
+    tik = time.time()
+    for _ in range(args.repeat):
+        func(*inputs)
+    return (time.time() - tik) / args.repeat
+
+
+def main():
+    print(f"device: {args.device}, threads: {torch.get_num_threads()}, "
+          f"vocab: {args.vocab_size}, prompt: {args.prompt_len}, output: {args.output_len}")
+    print(f"{'setting':>12} {'batch':>5} {'per_row':>9} {'hf':>9} {'batched':>9} {'speedup':>8}")
+    for name, params in SETTINGS.items():
+        for batch_size in args.batch_sizes:
+            logits = torch.randn(batch_size, args.vocab_size, device=args.device) * 3
+            ids = torch.randint(0, args.vocab_size, (batch_size, args.prompt_len + args.output_len))
+            prompt_ids = [row[:args.prompt_len].tolist() for row in ids]
+            output_ids = [row[args.prompt_len:].tolist() for row in ids]
+
+            inputs = (params, prompt_ids, output_ids)
+            times = {}
+            for method, func in (("per_row", sample_per_row), ("hf", sample_hf),
+                                 ("batched", sample_batched)):
+                times[method] = benchmark(lambda: func(logits.clone(), *inputs))
+            # The old sampler only supports temperature.
+            old = times["per_row"] if name in ("greedy", "temperature") else times["hf"]
+            print(f"{name:>12} {batch_size:>5} {times['per_row'] * 1e3:>7.3f}ms "
+                  f"{times['hf'] * 1e3:>7.3f}ms {times['batched'] * 1e3:>7.3f}ms "
+                  f"{old / times['batched']:>7.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, choices=["cpu", "cuda", "mps"], default="cpu")
+    parser.add_argument("--vocab-size", type=int, default=32000)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--prompt-len", type=int, default=512)
+    parser.add_argument("--output-len", type=int, default=256)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    main()
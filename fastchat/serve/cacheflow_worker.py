@@ -10,7 +10,6 @@ launch Gradio:
 """
 import argparse
 import asyncio
-import json
 import threading
 import time
 import uuid
@@ -28,6 +27,11 @@ from cacheflow.sampling_params import SamplingParams
 from cacheflow.sequence import Sequence, SequenceGroup
 from cacheflow.utils import Counter, get_gpu_memory, get_cpu_memory
 from fastchat.constants import WORKER_HEART_BEAT_INTERVAL
+from fastchat.serve.detokenizer import IncrementalDetokenizer
+from fastchat.serve.parallel_sampling import get_num_samples
+from fastchat.serve.stop_matcher import StopMatcher, get_stop_strs
+from fastchat.serve.stream_protocol import (STREAM_PROTOCOL_DELTA,
+    DeltaEncoder, encode_frame)
 from fastchat.utils import build_logger, pretty_print_semaphore
 
 GB = 1 << 30
@@ -141,6 +145,15 @@ class CacheFlowWorker:
         if not exist:
             self.register_to_controller()
 
+    def report_request_done(self, dispatch_id):
+        url = self.controller_addr + "/receive_request_done"
+        try:
+            requests.post(url, json={
+                "worker_name": self.worker_addr,
+                "dispatch_id": dispatch_id}, timeout=5)
+        except requests.exceptions.RequestException as e:
+            logger.error(f"report request done error: {e}")
+
     def get_queue_length(self):
         if model_semaphore is None or model_semaphore._value is None or model_semaphore._waiters is None:
             return 0
@@ -162,6 +175,9 @@ class CacheFlowWorker:
         # Notify the waiting coroutines that there new outputs ready.
         for seq_group in updated_seq_groups:
             group_id = seq_group.group_id
+            if group_id not in self.sequence_group_events:
+                # The stream stopped at a stop string of its own.
+                continue
             self.running_seq_groups[group_id] = seq_group
             self.sequence_group_events[group_id].set()
 
@@ -170,7 +186,15 @@ class CacheFlowWorker:
         context = params["prompt"]
         temperature = float(params.get("temperature", 1.0))
         max_new_tokens = min(int(params.get("max_new_tokens", 256)), 1024)
-        stop_str = params.get("stop", None)
+        stop_strs = get_stop_strs(params)
+        try:
+            n, best_of = get_num_samples(params)
+            if best_of != n:
+                raise ValueError("best_of is not supported by the cacheflow worker.")
+        except ValueError as e:
+            yield encode_frame({"text": str(e), "error_code": 5})
+            return
+        delta = params.get("stream_protocol") == STREAM_PROTOCOL_DELTA
 
         input_ids = tokenizer(context).input_ids
         max_src_len = self.context_len - max_new_tokens - 8
@@ -179,12 +203,15 @@ class CacheFlowWorker:
         # make sampling params in cacheflow
         sampling_params = SamplingParams.from_dict(params)
         sampling_params.stop_token_ids.add(tokenizer.eos_token_id)
-        sampling_params.n = 1
+        sampling_params.stop_token_ids.update(params.get("stop_token_ids", None) or [])
+        # The sequences share the blocks of the prompt.
+        sampling_params.n = n
         sampling_params.max_num_steps = max_new_tokens
         sampling_params.temperature = temperature
-        if stop_str is not None:
-            sampling_params.stop_str = stop_str
-        # we might sample multiple sequences, but in chatbot, this is one
+        if len(stop_strs) == 1:
+            # Cacheflow only stops at one string. Other stop strings are
+            # matched here and end the stream, but not the sequence.
+            sampling_params.stop_str = stop_strs[0]
         seqs: List[Sequence] = []
         for _ in range(sampling_params.n):
             seq_id = next(self.seq_counter)
@@ -196,6 +223,13 @@ class CacheFlowWorker:
         # logger.info(f"Group {group_id} arrives at {time.time()}")
         seq_group = SequenceGroup(group_id, seqs, arrival_time)
         group_event = asyncio.Event()
+        detokenizers = [IncrementalDetokenizer(tokenizer, input_ids) for _ in seqs]
+        stop_matchers = [StopMatcher(stop_strs, sampling_params.stop_token_ids)
+                         for _ in seqs]
+        stop_positions = [None for _ in seqs]
+        if delta:
+            encoders = [DeltaEncoder(stop_strs) for _ in seqs]
+        finished = [False for _ in seqs]
         self.running_seq_groups[group_id] = seq_group
         self.sequence_group_events[group_id] = group_event
         self.server.add_sequence_groups([(seq_group, sampling_params)])
@@ -208,21 +242,54 @@ class CacheFlowWorker:
                 pass
             group_event.clear()
             seq_group = self.running_seq_groups[group_id]
-            all_outputs = []
-            for seq in seq_group.seqs:
+            for j, (seq, detokenizer) in enumerate(zip(seq_group.seqs, detokenizers)):
+                if finished[j]:
+                    continue
                 token_ids = seq.get_token_ids()
-                output = self.tokenizer.decode(token_ids, skip_special_tokens=True)
-                if stop_str is not None:
-                    if output.endswith(stop_str):
-                        output = output[:-len(stop_str)]
-                all_outputs.append(output)
-            assert len(seq_group.seqs) == 1
-            ret = {
-                "text": all_outputs[0],
-                "error_code": 0,
-            }
-            yield (json.dumps(ret) + "\0").encode("utf-8")
-            if seq_group.is_finished():
+                num_decoded = len(input_ids) + len(detokenizer.output_ids)
+                new_token_ids = token_ids[num_decoded:]
+                # Feed one token at a time to find the exact stop step.
+                for k, token in enumerate(new_token_ids):
+                    if stop_positions[j] is not None:
+                        new_token_ids = new_token_ids[:k]
+                        break
+                    stop_positions[j] = stop_matchers[j].update(
+                        token, detokenizer.add_tokens([token]))
+                output = detokenizer.output[:stop_positions[j]]
+                num_generated = len(detokenizer.output_ids)
+                if stop_positions[j] is not None:
+                    finish_reason = "stop"
+                elif not seq_group.is_finished():
+                    finish_reason = None
+                elif num_generated >= max_new_tokens:
+                    finish_reason = "length"
+                else:
+                    finish_reason = "stop"
+                output = {
+                    "text": output if delta else detokenizer.prompt_text + output,
+                    "token_ids": new_token_ids,
+                    "usage": {
+                        "prompt_tokens": len(input_ids),
+                        "completion_tokens": num_generated,
+                        "total_tokens": len(input_ids) + num_generated,
+                    },
+                    "finish_reason": finish_reason,
+                }
+                finished[j] = finish_reason is not None
+                if delta:
+                    ret = encoders[j].update(output)
+                    if finished[j]:
+                        ret = encoders[j].finish()
+                else:
+                    ret = {
+                        "text": output["text"],
+                        "error_code": 0,
+                    }
+                if ret is not None:
+                    if n > 1:
+                        ret["index"] = j
+                    yield encode_frame(ret)
+            if all(finished):
                 del self.running_seq_groups[group_id]
                 del self.sequence_group_events[group_id]
                 break
@@ -247,6 +314,8 @@ async def generate_stream(request: Request):
     await model_semaphore.acquire()
     background_tasks = BackgroundTasks()
     background_tasks.add_task(release_model_semaphore)
+    if "dispatch_id" in params:
+        background_tasks.add_task(worker.report_request_done, params["dispatch_id"])
     # return StreamingResponse(generator, background=background_tasks)
     return StreamingResponse(worker.generate_stream(params), background=background_tasks)
 
@@ -15,6 +15,7 @@ from rich.console import Console
 from rich.markdown import Markdown
 from rich.live import Live
 
+from fastchat.serve.compression import add_compression_args, get_compression_config
 from fastchat.serve.inference import chat_loop, ChatIO
 
 
@@ -25,10 +26,10 @@ class SimpleChatIO(ChatIO):
     def prompt_for_output(self, role: str):
         print(f"{role}: ", end="", flush=True)
 
-    def stream_output(self, output_stream, skip_echo_len: int):
+    def stream_output(self, output_stream):
         pre = 0
         for outputs in output_stream:
-            outputs = outputs[skip_echo_len:].strip()
+            outputs = outputs["text"].strip()
             outputs = outputs.split(" ")
             now = len(outputs) - 1
             if now > pre:
@@ -58,7 +59,7 @@ class RichChatIO(ChatIO):
     def prompt_for_output(self, role: str):
         self._console.print(f"[bold]{role}:")
 
-    def stream_output(self, output_stream, skip_echo_len: int):
+    def stream_output(self, output_stream):
         """Stream output from a role."""
         # TODO(suquark): the console flickers when there is a code block
         #  above it. We need to cut off "live" when a code block is done.
@@ -67,7 +68,7 @@ class RichChatIO(ChatIO):
         with Live(console=self._console, refresh_per_second=4) as live:
             # Read lines from the stream
             for outputs in output_stream:
-                accumulated_text = outputs[skip_echo_len:]
+                accumulated_text = outputs["text"]
                 if not accumulated_text:
                     continue
                 # Render the accumulated text as Markdown
@@ -94,7 +95,7 @@ class RichChatIO(ChatIO):
                 # Update the Live console output
                 live.update(markdown)
         self._console.print()
-        return outputs[skip_echo_len:]
+        return outputs["text"]
 
 
 def main(args):
@@ -107,7 +108,8 @@ def main(args):
     try:
         chat_loop(args.model_path, args.device, args.num_gpus, args.max_gpu_memory,
             args.load_8bit, args.conv_template, args.temperature, args.max_new_tokens,
-            chatio, args.debug)
+            chatio, args.debug, args.draft_model_path, args.num_speculative_tokens,
+            get_compression_config(args))
     except KeyboardInterrupt:
         print("exit...")
 
@@ -119,8 +121,7 @@ if __name__ == "__main__":
     parser.add_argument("--device", type=str, choices=["cpu", "cuda", "mps"], default="cuda")
     parser.add_argument("--num-gpus", type=str, default="1")
     parser.add_argument("--max-gpu-memory", type=str, default="13GiB")
-    parser.add_argument("--load-8bit", action="store_true",
-        help="Use 8-bit quantization.")
+    add_compression_args(parser)
     parser.add_argument("--conv-template", type=str, default=None,
         help="Conversation prompt template.")
     parser.add_argument("--temperature", type=float, default=0.7)
@@ -128,5 +129,9 @@ if __name__ == "__main__":
     parser.add_argument("--style", type=str, default="simple",
                         choices=["simple", "rich"], help="Display style.")
     parser.add_argument("--debug", action="store_true")
+    parser.add_argument("--draft-model-path", type=str, default=None,
+        help="A small model with the same tokenizer for speculative decoding.")
+    parser.add_argument("--num-speculative-tokens", type=int, default=4,
+        help="The number of tokens the draft model proposes per step.")
     args = parser.parse_args()
     main(args)
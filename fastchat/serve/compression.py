@@ -1,4 +1,5 @@
 import dataclasses
+import functools
 
 import torch
 from torch import Tensor
@@ -23,25 +24,95 @@ default_compression_config = CompressionConfig(
 class CLinear(nn.Module):
     """Compressed Linear Layer."""
 
-    def __init__(self, weight, bias, device):
+    def __init__(self, weight, bias, device, config=default_compression_config):
         super().__init__()
 
-        self.weight = compress(weight.data.to(device), default_compression_config)
+        self.config = config
+        if isinstance(weight, tuple):
+            # Already compressed, e.g. loaded from a compressed checkpoint.
+            self.weight = tuple(x.to(device) if isinstance(x, Tensor) else x
+                                for x in weight)
+        else:
+            self.weight = compress(weight.data.to(device), config)
         self.bias = bias
 
     def forward(self, input: Tensor) -> Tensor:
-        weight = decompress(self.weight, default_compression_config)
-        return F.linear(input, weight, self.bias)
+        return compressed_linear(input, self.weight, self.bias, self.config)
 
 
-def compress_module(module, target_device):
-    for attr_str in dir(module):
-        target_attr = getattr(module, attr_str)
-        if type(target_attr) == torch.nn.Linear:
-            setattr(module, attr_str,
-                CLinear(target_attr.weight, target_attr.bias, target_device))
+def compress_module(module, target_device, config=default_compression_config):
     for name, child in module.named_children():
-        compress_module(child, target_device)
+        if type(child) == torch.nn.Linear:
+            setattr(module, name,
+                CLinear(child.weight, child.bias, target_device, config))
+        else:
+            compress_module(child, target_device, config)
+
+
+def add_compression_args(parser):
+    parser.add_argument("--load-8bit", action="store_true",
+        help="Use 8-bit quantization.")
+    parser.add_argument("--compression-bits", type=int, choices=[2, 3, 4, 8],
+        default=None, help="Use group-wise quantization with this many bits. "
+                           "Values below 8 bits are bit-packed.")
+    parser.add_argument("--compression-group-size", type=int,
+        default=default_compression_config.group_size,
+        help="The number of weights that share a quantization scale.")
+    parser.add_argument("--compression-asymmetric", action="store_true",
+        help="Quantize with a minimum and a scale per group instead of a scale.")
+
+
+def get_compression_config(args):
+    """Return the CompressionConfig of the command line arguments, or None."""
+    if args.compression_bits is None and not args.load_8bit:
+        return None
+    return CompressionConfig(
+        num_bits=args.compression_bits or 8,
+        group_size=args.compression_group_size,
+        group_dim=1,
+        symmetric=not args.compression_asymmetric)
+
+
+def pack_bits(data, num_bits, dim):
+    """Pack unsigned `num_bits`-bit values stored in uint8 along `dim`.
+
+    If `num_bits` divides 8, 8 // num_bits consecutive values share a byte and
+    `dim` shrinks by that factor. Otherwise (3 bits), bit i of every 8
+    consecutive values is packed into one byte of bit plane i, and `dim` is
+    replaced by two: (num_bits, size // 8).
+    """
+    data = data.movedim(dim, -1)
+    if 8 % num_bits == 0:
+        per_byte = 8 // num_bits
+        data = data.reshape(*data.shape[:-1], -1, per_byte)
+        shifts = num_bits * torch.arange(per_byte, dtype=torch.uint8, device=data.device)
+        packed = (data << shifts).sum(dim=-1, dtype=torch.uint8)
+        return packed.movedim(-1, dim)
+
+    data = data.reshape(*data.shape[:-1], 1, data.shape[-1] // 8, 8)
+    bits = torch.arange(num_bits, dtype=torch.uint8, device=data.device)
+    planes = (data >> bits.view(-1, 1, 1)) & 1
+    weights = 2 ** torch.arange(8, dtype=torch.uint8, device=data.device)
+    packed = (planes * weights).sum(dim=-1, dtype=torch.uint8)
+    return packed.movedim(-2, dim).movedim(-1, dim + 1)
+
+
+def unpack_bits(packed, num_bits, dim):
+    """Inverse of pack_bits."""
+    if 8 % num_bits == 0:
+        per_byte = 8 // num_bits
+        packed = packed.movedim(dim, -1)
+        shifts = num_bits * torch.arange(per_byte, dtype=torch.uint8, device=packed.device)
+        data = (packed.unsqueeze(-1) >> shifts) & (2 ** num_bits - 1)
+        return data.reshape(*data.shape[:-2], -1).movedim(-1, dim)
+
+    packed = packed.movedim(dim + 1, -1).movedim(dim, -2)
+    shifts = torch.arange(8, dtype=torch.uint8, device=packed.device)
+    planes = (packed.unsqueeze(-1) >> shifts) & 1
+    bits = torch.arange(num_bits, dtype=torch.uint8, device=packed.device)
+    data = (planes << bits.view(-1, 1, 1)).sum(dim=-3, dtype=torch.uint8)
+    data = data.reshape(*data.shape[:-2], -1)
+    return data.movedim(-1, dim)
 
 
 def compress(tensor, config):
@@ -52,6 +123,7 @@ def compress(tensor, config):
     group_size, num_bits, group_dim, symmetric = (
         config.group_size, config.num_bits, config.group_dim, config.symmetric)
     assert num_bits <= 8
+    assert num_bits == 8 or group_size % 8 == 0
 
     original_shape = tensor.shape
     num_groups = (original_shape[group_dim] + group_size - 1) // group_size
@@ -74,6 +146,8 @@ def compress(tensor, config):
         scale = B / torch.max(data.abs(), dim=group_dim + 1, keepdim=True)[0]
         data = data * scale
         data = data.clamp_(-B, B).round_().to(torch.int8)
+        if num_bits < 8:
+            data = pack_bits((data + B).to(torch.uint8), num_bits, group_dim + 1)
         return data, scale, original_shape
     else:
         B = 2 ** num_bits - 1
@@ -85,9 +159,21 @@ def compress(tensor, config):
         data.mul_(scale)
 
         data = data.clamp_(0, B).round_().to(torch.uint8)
+        if num_bits < 8:
+            data = pack_bits(data, num_bits, group_dim + 1)
         return data, mn, scale, original_shape
 
 
+def unpack_int(data, config, dim):
+    """Return the quantized integers of bit-packed data."""
+    if config.num_bits == 8:
+        return data
+    data = unpack_bits(data, config.num_bits, dim)
+    if config.symmetric:
+        data = data.to(torch.int8) - (2 ** (config.num_bits - 1) - 1)
+    return data
+
+
 def decompress(packed_data, config):
     """Simulate group-wise dequantization."""
     if not config.enabled:
@@ -99,9 +185,11 @@ def decompress(packed_data, config):
     # Dequantize
     if symmetric:
         data, scale, original_shape = packed_data
+        data = unpack_int(data, config, group_dim + 1)
         data = data / scale
     else:
         data, mn, scale, original_shape = packed_data
+        data = unpack_int(data, config, group_dim + 1)
         data = data / scale
         data.add_(mn)
 
@@ -114,6 +202,78 @@ def decompress(packed_data, config):
             original_shape[group_dim+1:])
         data = data.reshape(padded_original_shape)
         indices = [slice(0, x) for x in original_shape]
-        return data[indices].contiguous()
+        return data[tuple(indices)].contiguous()
     else:
         return data.view(original_shape)
+
+
+@functools.lru_cache(maxsize=None)
+def cpu_int_mm_supported():
+    """Whether torch._int_mm runs on CPU. Before torch 2.3 it is CUDA-only."""
+    if not hasattr(torch, "_int_mm"):
+        return False
+    try:
+        a = torch.ones(32, 32, dtype=torch.int8)
+        torch._int_mm(a, a)
+    except RuntimeError:
+        return False
+    return True
+
+
+def compressed_linear(input, packed_data, bias, config):
+    """F.linear with a compressed weight, without decompressing the whole weight.
+
+    The weight must be grouped along the input dimension (group_dim=1), so
+    that every group only touches a slice of the input. The output is then
+    the sum over groups of the input slice times the quantized group, scaled
+    per output channel. On CPU, if torch has int8 matmuls there, the input
+    slices are quantized to int8 on the fly and multiplied with them.
+    Elsewhere, one group at a time is dequantized.
+    """
+    if not config.enabled:
+        return F.linear(input, packed_data, bias)
+    group_size, num_bits, group_dim, symmetric = (
+        config.group_size, config.num_bits, config.group_dim, config.symmetric)
+    if group_dim != 1:
+        return F.linear(input, decompress(packed_data, config), bias)
+
+    if symmetric:
+        data, scale, original_shape = packed_data
+        mn = None
+    else:
+        data, mn, scale, original_shape = packed_data
+    # data: [out_features, num_groups, ...], the group is bit-packed
+    # if num_bits < 8
+    out_features, num_groups = data.shape[:2]
+
+    x = input.reshape(-1, original_shape[1])
+    pad_len = num_groups * group_size - original_shape[1]
+    if pad_len:
+        x = F.pad(x, (0, pad_len))
+    x = x.view(-1, num_groups, group_size)
+    inv_scale = (1 / scale).view(out_features, num_groups).to(x.dtype)
+
+    if symmetric and data.device.type == "cpu" and cpu_int_mm_supported():
+        # Dynamic per-group int8 quantization of the input.
+        x_scale = x.abs().amax(dim=-1, keepdim=True).float().clamp_(min=1e-8) / 127
+        x_int8 = (x / x_scale).round_().to(torch.int8)
+        output = None
+        for g in range(num_groups):
+            w = unpack_int(data[:, g], config, 1)
+            y = torch._int_mm(x_int8[:, g].contiguous(), w.t()).float()
+            y.mul_(x_scale[:, g]).mul_(inv_scale[:, g])
+            output = y if output is None else output.add_(y)
+        output = output.to(input.dtype)
+    else:
+        output = None
+        for g in range(num_groups):
+            w = unpack_int(data[:, g], config, 1)
+            y = (x[:, g] @ w.t().to(x.dtype)).mul_(inv_scale[:, g])
+            if mn is not None:
+                y.add_(x[:, g].sum(dim=-1, keepdim=True) *
+                       mn.view(out_features, num_groups)[:, g].to(x.dtype))
+            output = y if output is None else output.add_(y)
+
+    if bias is not None:
+        output = output + bias
+    return output.view(*input.shape[:-1], out_features)
@@ -4,21 +4,24 @@ It sends worker addresses to clients.
 """
 import argparse
 import asyncio
+import bisect
 import dataclasses
 from enum import Enum, auto
-import json
+import hashlib
 import logging
+import math
 import time
-from typing import List, Union
-import threading
+from typing import Dict, List, Union
+import uuid
 
 from fastapi import FastAPI, Request
 from fastapi.responses import StreamingResponse
+import httpx
 import numpy as np
-import requests
 import uvicorn
 
 from fastchat.constants import CONTROLLER_HEART_BEAT_EXPIRATION
+from fastchat.serve.stream_protocol import encode_frame
 from fastchat.utils import build_logger, server_error_msg
 
 
@@ -28,6 +31,8 @@ logger = build_logger("controller", "controller.log")
 class DispatchMethod(Enum):
     LOTTERY = auto()
     SHORTEST_QUEUE = auto()
+    POWER_OF_TWO = auto()
+    SESSION_AFFINITY = auto()
 
     @classmethod
     def from_str(cls, name):
@@ -35,6 +40,10 @@ class DispatchMethod(Enum):
             return cls.LOTTERY
         elif name == "shortest_queue":
             return cls.SHORTEST_QUEUE
+        elif name == "power_of_two":
+            return cls.POWER_OF_TWO
+        elif name == "session_affinity":
+            return cls.SESSION_AFFINITY
         else:
             raise ValueError(f"Invalid dispatch method")
 
@@ -46,49 +55,108 @@ class WorkerInfo:
     queue_length: int
     check_heart_beat: bool
     last_heart_beat: str
+    # Requests dispatched by this controller that have not finished yet.
+    # Dict[dispatch_id -> dispatch time]
+    in_flight: Dict[str, float] = dataclasses.field(default_factory=dict)
+    # Requests on the worker that this controller does not track, e.g.
+    # requests sent by another controller. Estimated at every heart beat.
+    untracked: int = 0
 
+    def num_requests(self):
+        return len(self.in_flight) + self.untracked
 
-def heart_beat_controller(controller):
+    def load(self):
+        return self.num_requests() / self.speed
+
+
+def hash_key(key: str):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """A consistent hash ring with virtual nodes weighted by worker speed."""
+
+    def __init__(self, worker_speeds: Dict[str, int], num_replicas: int = 64):
+        self.ring = sorted(
+            (hash_key(f"{w_name}#{i}"), w_name)
+            for w_name, speed in worker_speeds.items()
+            for i in range(num_replicas * max(int(speed), 1)))
+        self.hashes = [h for h, _ in self.ring]
+
+    def walk(self, key: str):
+        """Yield each worker once, clockwise from the position of the key."""
+        start = bisect.bisect(self.hashes, hash_key(key))
+        seen = set()
+        for i in range(len(self.ring)):
+            w_name = self.ring[(start + i) % len(self.ring)][1]
+            if w_name not in seen:
+                seen.add(w_name)
+                yield w_name
+
+
+async def heart_beat_controller(controller):
     while True:
-        time.sleep(CONTROLLER_HEART_BEAT_EXPIRATION)
+        await asyncio.sleep(CONTROLLER_HEART_BEAT_EXPIRATION)
         controller.remove_stable_workers_by_expiration()
 
 
 class Controller:
-    def __init__(self, dispatch_method: str):
+    def __init__(self, dispatch_method: str, max_connections_per_worker: int = 1024,
+                 affinity_load_factor: float = 1.25):
         # Dict[str -> WorkerInfo]
         self.worker_info = {}
         self.dispatch_method = DispatchMethod.from_str(dispatch_method)
 
-        self.heart_beat_thread = threading.Thread(
-            target=heart_beat_controller, args=(self,))
-        self.heart_beat_thread.start()
+        # A session stays on its worker unless that worker has more than
+        # affinity_load_factor times its fair share of the requests.
+        self.affinity_load_factor = affinity_load_factor
+        # Dict[model_name -> (worker speeds, HashRing)]
+        self.hash_rings = {}
+
+        # Dict[str -> httpx.AsyncClient]. One keep-alive connection pool per
+        # worker, shared by all proxied streams and status calls.
+        self.worker_clients = {}
+        self.worker_limits = httpx.Limits(
+            max_connections=max_connections_per_worker,
+            max_keepalive_connections=max_connections_per_worker)
 
         logger.info("Init controller")
 
-    def register_worker(self, worker_name: str, check_heart_beat: bool,
-                        worker_status: dict):
+    def get_worker_client(self, worker_name: str):
+        client = self.worker_clients.get(worker_name)
+        if client is None:
+            client = httpx.AsyncClient(base_url=worker_name,
+                limits=self.worker_limits, timeout=15)
+            self.worker_clients[worker_name] = client
+        return client
+
+    async def register_worker(self, worker_name: str, check_heart_beat: bool,
+                              worker_status: dict):
         if worker_name not in self.worker_info:
             logger.info(f"Register a new worker: {worker_name}")
         else:
             logger.info(f"Register an existing worker: {worker_name}")
 
         if not worker_status:
-            worker_status = self.get_worker_status(worker_name)
+            worker_status = await self.get_worker_status(worker_name)
         if not worker_status:
             return False
 
+        old_info = self.worker_info.get(worker_name, None)
         self.worker_info[worker_name] = WorkerInfo(
             worker_status["model_names"], worker_status["speed"], worker_status["queue_length"],
             check_heart_beat, time.time())
+        if old_info is not None:
+            self.worker_info[worker_name].in_flight = old_info.in_flight
 
         logger.info(f"Register done: {worker_name}, {worker_status}")
         return True
 
-    def get_worker_status(self, worker_name: str):
+    async def get_worker_status(self, worker_name: str):
         try:
-            r = requests.post(worker_name + "/worker_get_status", timeout=5)
-        except requests.exceptions.RequestException as e:
+            r = await self.get_worker_client(worker_name).post(
+                "/worker_get_status", timeout=5)
+        except httpx.HTTPError as e:
             logger.error(f"Get status fails: {worker_name}, {e}")
             return None
 
@@ -100,14 +168,26 @@ class Controller:
 
     def remove_worker(self, worker_name: str):
         del self.worker_info[worker_name]
+        self.close_worker_client(worker_name)
 
-    def refresh_all_workers(self):
+    def close_worker_client(self, worker_name: str):
+        client = self.worker_clients.pop(worker_name, None)
+        if client is not None:
+            asyncio.create_task(client.aclose())
+
+    async def refresh_all_workers(self):
         old_info = dict(self.worker_info)
         self.worker_info = {}
 
-        for w_name, w_info in old_info.items():
-            if not self.register_worker(w_name, w_info.check_heart_beat, None):
+        registered = await asyncio.gather(*[
+            self.register_worker(w_name, w_info.check_heart_beat, None)
+            for w_name, w_info in old_info.items()])
+        for w_name, ok in zip(old_info, registered):
+            if ok:
+                self.worker_info[w_name].in_flight = old_info[w_name].in_flight
+            else:
                 logger.info(f"Remove stale worker: {w_name}")
+                self.close_worker_client(w_name)
 
     def list_models(self):
         model_names = set()
@@ -117,7 +197,10 @@ class Controller:
 
         return list(model_names)
 
-    def get_worker_address(self, model_name: str):
+    def get_worker_address(self, model_name: str, session_id: str = None):
+        if self.dispatch_method == DispatchMethod.SESSION_AFFINITY and session_id:
+            return self.get_worker_address_by_session(model_name, session_id)
+
         if self.dispatch_method == DispatchMethod.LOTTERY:
             worker_names = []
             worker_speeds = []
@@ -130,28 +213,9 @@ class Controller:
             if norm < 1e-4:
                 return ""
             worker_speeds = worker_speeds / norm
-            if True:  # Directly return address
-                pt = np.random.choice(np.arange(len(worker_names)),
-                    p=worker_speeds)
-                worker_name = worker_names[pt]
-                return worker_name
-
-            # Check status before returning
-            while True:
-                pt = np.random.choice(np.arange(len(worker_names)),
-                    p=worker_speeds)
-                worker_name = worker_names[pt]
-
-                if self.get_worker_status(worker_name):
-                    break
-                else:
-                    self.remove_worker(worker_name)
-                    worker_speeds[pt] = 0
-                    norm = np.sum(worker_speeds)
-                    if norm < 1e-4:
-                        return ""
-                    worker_speeds = worker_speeds / norm
-                    continue
+            pt = np.random.choice(np.arange(len(worker_names)),
+                p=worker_speeds)
+            worker_name = worker_names[pt]
             return worker_name
         elif self.dispatch_method == DispatchMethod.SHORTEST_QUEUE:
             worker_names = []
@@ -159,24 +223,94 @@ class Controller:
             for w_name, w_info in self.worker_info.items():
                 if model_name in w_info.model_names:
                     worker_names.append(w_name)
-                    worker_qlen.append(w_info.queue_length / w_info.speed)
+                    worker_qlen.append(w_info.load())
             if len(worker_names) == 0:
                 return ""
             min_index = np.argmin(worker_qlen)
             w_name = worker_names[min_index]
-            self.worker_info[w_name].queue_length += 1
             logger.info(f"names: {worker_names}, queue_lens: {worker_qlen}, ret: {w_name}")
             return w_name
+        elif self.dispatch_method in (DispatchMethod.POWER_OF_TWO,
+                                      DispatchMethod.SESSION_AFFINITY):
+            worker_names = [w_name for w_name, w_info in self.worker_info.items()
+                            if model_name in w_info.model_names]
+            if len(worker_names) == 0:
+                return ""
+            if len(worker_names) == 1:
+                return worker_names[0]
+            a, b = np.random.choice(len(worker_names), size=2, replace=False)
+            w_a, w_b = worker_names[a], worker_names[b]
+            if self.worker_info[w_a].load() <= self.worker_info[w_b].load():
+                return w_a
+            return w_b
         else:
             raise ValueError(f"Invalid dispatch method: {self.dispatch_method}")
 
-    def receive_heart_beat(self, worker_name: str, queue_length: int):
+    def get_worker_address_by_session(self, model_name: str, session_id: str):
+        """Consistent hashing with bounded loads.
+
+        The session goes to the first worker on the hash ring, starting from
+        the hash of the session id, whose load stays within its capacity
+        after taking this request. Turns of one conversation thus stay on one
+        worker, and only move when that worker is saturated.
+        """
+        worker_speeds = {w_name: w_info.speed for w_name, w_info in self.worker_info.items()
+                         if model_name in w_info.model_names}
+        if len(worker_speeds) == 0:
+            return ""
+
+        speeds, ring = self.hash_rings.get(model_name, (None, None))
+        if speeds != worker_speeds:
+            ring = HashRing(worker_speeds)
+            self.hash_rings[model_name] = (worker_speeds, ring)
+
+        total_requests = sum(self.worker_info[w_name].num_requests()
+                             for w_name in worker_speeds) + 1
+        total_speed = sum(worker_speeds.values())
+        for w_name in ring.walk(session_id):
+            capacity = math.ceil(self.affinity_load_factor * total_requests *
+                                 worker_speeds[w_name] / total_speed)
+            if self.worker_info[w_name].num_requests() + 1 <= capacity:
+                return w_name
+        return w_name
+
+    def dispatch(self, model_name: str, session_id: str = None):
+        """Pick a worker and start tracking the request on it."""
+        worker_name = self.get_worker_address(model_name, session_id)
+        if not worker_name:
+            return "", None
+        dispatch_id = uuid.uuid4().hex
+        self.worker_info[worker_name].in_flight[dispatch_id] = time.time()
+        return worker_name, dispatch_id
+
+    def receive_request_done(self, worker_name: str, dispatch_id: str):
+        w_info = self.worker_info.get(worker_name, None)
+        if w_info is not None:
+            w_info.in_flight.pop(dispatch_id, None)
+
+    def receive_heart_beat(self, worker_name: str, queue_length: int,
+                           num_requests: int = None):
         if worker_name not in self.worker_info:
             logger.info(f"Receive unknown heart beat. {worker_name}")
             return False
 
-        self.worker_info[worker_name].queue_length = queue_length
-        self.worker_info[worker_name].last_heart_beat = time.time()
+        w_info = self.worker_info[worker_name]
+        # Requests dispatched before the previous heart beat have reached the
+        # worker by now. If there are more of them than the worker reports,
+        # their completion was never reported (e.g. the client went away
+        # before sending them), so the oldest ones are dropped. Workers whose
+        # queue length is weighted by tokens report their number of requests
+        # separately.
+        if num_requests is None:
+            num_requests = queue_length
+        old = sorted((t, d) for d, t in w_info.in_flight.items()
+                     if t < w_info.last_heart_beat)
+        for _, dispatch_id in old[:max(len(old) - num_requests, 0)]:
+            del w_info.in_flight[dispatch_id]
+        w_info.untracked = max(num_requests - len(w_info.in_flight), 0)
+
+        w_info.queue_length = queue_length
+        w_info.last_heart_beat = time.time()
         logger.info(f"Receive heart beat. {worker_name}")
         return True
 
@@ -190,66 +324,88 @@ class Controller:
         for worker_name in to_delete:
             self.remove_worker(worker_name)
 
-    def worker_api_generate_stream(self, params):
-        worker_addr = self.get_worker_address(params["model"])
+    async def worker_api_generate_stream(self, params):
+        # Frames are forwarded as they are, so both the full and the delta
+        # stream protocols pass through the controller unchanged.
+        worker_addr, dispatch_id = self.dispatch(
+            params["model"], params.get("session_id", None))
         if not worker_addr:
             logger.info(f"no worker: {params['model']}")
             ret = {
                 "text": server_error_msg,
                 "error_code": 2,
             }
-            yield json.dumps(ret).encode() + b"\0"
+            yield encode_frame(ret)
+            return
 
         try:
-            response = requests.post(worker_addr + "/worker_generate_stream",
-                json=params, stream=True, timeout=15)
-            for chunk in response.iter_lines(decode_unicode=False, delimiter=b"\0"):
-                if chunk:
-                    yield chunk + b"\0"
-        except requests.exceptions.RequestException as e:
+            client = self.get_worker_client(worker_addr)
+            async with client.stream("POST", "/worker_generate_stream",
+                                     json=params) as response:
+                # Only forward whole frames, so that an error frame can
+                # always be appended if the worker fails midway.
+                buffer = b""
+                async for chunk in response.aiter_raw():
+                    buffer += chunk
+                    end = buffer.rfind(b"\0") + 1
+                    if end:
+                        yield buffer[:end]
+                        buffer = buffer[end:]
+        except httpx.HTTPError as e:
             logger.info(f"worker timeout: {worker_addr}")
             ret = {
                 "text": server_error_msg,
                 "error_code": 3,
             }
-            yield json.dumps(ret).encode() + b"\0"
-
+            yield encode_frame(ret)
+        finally:
+            self.receive_request_done(worker_addr, dispatch_id)
 
     # Let the controller act as a worker to achieve hierarchical
     # management. This can be used to connect isolated sub networks.
-    def worker_api_get_status(self):
+    async def worker_api_get_status(self):
         model_names = set()
         speed = 0
         queue_length = 0
+        num_requests = 0
 
-        for w_name in self.worker_info:
-            worker_status = self.get_worker_status(w_name)
+        all_status = await asyncio.gather(*[
+            self.get_worker_status(w_name) for w_name in self.worker_info])
+        for worker_status in all_status:
             if worker_status is not None:
                 model_names.update(worker_status["model_names"])
                 speed += worker_status["speed"]
                 queue_length += worker_status["queue_length"]
+                num_requests += worker_status.get(
+                    "num_requests", worker_status["queue_length"])
 
         return {
             "model_names": list(model_names),
             "speed": speed,
             "queue_length": queue_length,
+            "num_requests": num_requests,
         }
 
 
 app = FastAPI()
 
 
+@app.on_event("startup")
+async def startup():
+    asyncio.create_task(heart_beat_controller(controller))
+
+
 @app.post("/register_worker")
 async def register_worker(request: Request):
     data = await request.json()
-    controller.register_worker(
+    await controller.register_worker(
         data["worker_name"], data["check_heart_beat"],
         data.get("worker_status", None))
 
 
 @app.post("/refresh_all_workers")
 async def refresh_all_workers():
-    models = controller.refresh_all_workers()
+    models = await controller.refresh_all_workers()
 
 
 @app.post("/list_models")
@@ -261,15 +417,22 @@ async def list_models():
 @app.post("/get_worker_address")
 async def get_worker_address(request: Request):
     data = await request.json()
-    addr = controller.get_worker_address(data["model"])
-    return {"address": addr}
+    addr, dispatch_id = controller.dispatch(
+        data["model"], data.get("session_id", None))
+    return {"address": addr, "dispatch_id": dispatch_id}
+
+
+@app.post("/receive_request_done")
+async def receive_request_done(request: Request):
+    data = await request.json()
+    controller.receive_request_done(data["worker_name"], data["dispatch_id"])
 
 
 @app.post("/receive_heart_beat")
 async def receive_heart_beat(request: Request):
     data = await request.json()
     exist = controller.receive_heart_beat(
-        data["worker_name"], data["queue_length"])
+        data["worker_name"], data["queue_length"], data.get("num_requests", None))
     return {"exist": exist}
 
 
@@ -282,7 +445,7 @@ async def worker_api_generate_stream(request: Request):
 
 @app.post("/worker_get_status")
 async def worker_api_get_status(request: Request):
-    return controller.worker_api_get_status()
+    return await controller.worker_api_get_status()
 
 
 if __name__ == "__main__":
@@ -290,9 +453,16 @@ if __name__ == "__main__":
     parser.add_argument("--host", type=str, default="localhost")
     parser.add_argument("--port", type=int, default=21001)
     parser.add_argument("--dispatch-method", type=str, choices=[
-        "lottery", "shortest_queue"], default="shortest_queue")
+        "lottery", "shortest_queue", "power_of_two", "session_affinity"],
+        default="shortest_queue")
+    parser.add_argument("--max-connections-per-worker", type=int, default=1024,
+        help="The size of the HTTP connection pool to each worker.")
+    parser.add_argument("--affinity-load-factor", type=float, default=1.25,
+        help="How far above its fair share a worker may be loaded before "
+             "session_affinity moves a session to another worker.")
     args = parser.parse_args()
     logger.info(f"args: {args}")
 
-    controller = Controller(args.dispatch_method)
+    controller = Controller(args.dispatch_method, args.max_connections_per_worker,
+                            args.affinity_load_factor)
     uvicorn.run(app, host=args.host, port=args.port, log_level="info")
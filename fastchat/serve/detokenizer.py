@@ -0,0 +1,56 @@
+"""Incremental detokenization for streamed generation."""
+from typing import List
+
+
+class IncrementalDetokenizer:
+    """Turn a growing list of token ids into text in O(1) per token.
+
+    Instead of decoding all tokens at every step, only a short window of the
+    most recent tokens is converted. The window starts a few tokens back so
+    that tokenizers which depend on the previous token (e.g. the leading
+    space of SentencePiece pieces) produce the same text as a full decode.
+    A token that ends in an incomplete UTF-8 sequence (SentencePiece byte
+    fallback, multi-token emoji or CJK characters) decodes to U+FFFD; its
+    text is held back until the following tokens complete the character.
+    """
+
+    # How many prompt tokens are kept as left context of the first window.
+    num_context_tokens = 5
+
+    def __init__(self, tokenizer, prompt_ids=None, skip_special_tokens=True):
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+
+        prompt_ids = prompt_ids or []
+        self.tokens: List[str] = tokenizer.convert_ids_to_tokens(
+            prompt_ids, skip_special_tokens=skip_special_tokens)
+        self.prompt_text = tokenizer.decode(
+            prompt_ids, skip_special_tokens=skip_special_tokens)
+        self.prefix_offset = max(len(self.tokens) - self.num_context_tokens, 0)
+        self.read_offset = len(self.tokens)
+        self.output_ids: List[int] = []
+        self.output = ""
+
+    @property
+    def text(self):
+        """The prompt followed by the output, as `tokenizer.decode` would give."""
+        return self.prompt_text + self.output
+
+    def add_tokens(self, token_ids: List[int]) -> str:
+        """Append new token ids and return the newly decoded text."""
+        self.output_ids.extend(token_ids)
+        self.tokens.extend(self.tokenizer.convert_ids_to_tokens(
+            token_ids, skip_special_tokens=self.skip_special_tokens))
+
+        prefix_text = self.tokenizer.convert_tokens_to_string(
+            self.tokens[self.prefix_offset:self.read_offset])
+        new_text = self.tokenizer.convert_tokens_to_string(
+            self.tokens[self.prefix_offset:])
+        if len(new_text) <= len(prefix_text) or new_text.endswith("\ufffd"):
+            return ""
+
+        delta = new_text[len(prefix_text):]
+        self.prefix_offset = self.read_offset
+        self.read_offset = len(self.tokens)
+        self.output += delta
+        return delta
@@ -16,7 +16,7 @@ from fastchat.utils import (build_logger, server_error_msg,
     violates_moderation, moderation_msg)
 from fastchat.serve.gradio_patch import Chatbot as grChatbot
 from fastchat.serve.gradio_css import code_highlight_css
-from fastchat.serve.inference import compute_skip_echo_len
+from fastchat.serve.stream_protocol import STREAM_PROTOCOL_DELTA, iter_frames
 
 
 logger = build_logger("gradio_web_server", "gradio_web_server.log")
@@ -194,8 +194,9 @@ def http_bot(state, model_selector, temperature, max_new_tokens, request: gr.Req
     # Query worker address
     controller_url = args.controller_url
     ret = requests.post(controller_url + "/get_worker_address",
-            json={"model": model_name})
+            json={"model": model_name, "session_id": state.conv_id})
     worker_addr = ret.json()["address"]
+    dispatch_id = ret.json().get("dispatch_id", None)
     logger.info(f"model_name: {model_name}, worker_addr: {worker_addr}")
 
     # No available worker
@@ -209,7 +210,6 @@ def http_bot(state, model_selector, temperature, max_new_tokens, request: gr.Req
         prompt = state.messages[state.offset:]
     else:
         prompt = state.get_prompt()
-    skip_echo_len = compute_skip_echo_len(model_name, state, prompt)
 
     # Make requests
     pload = {
@@ -218,7 +218,12 @@ def http_bot(state, model_selector, temperature, max_new_tokens, request: gr.Req
         "temperature": float(temperature),
         "max_new_tokens": int(max_new_tokens),
         "stop": state.sep if state.sep_style == SeparatorStyle.SINGLE else state.sep2,
+        "stream_protocol": STREAM_PROTOCOL_DELTA,
+        "session_id": state.conv_id,
     }
+    if dispatch_id:
+        # Let the worker tell the controller when this request is done.
+        pload["dispatch_id"] = dispatch_id
     logger.info(f"==== request ====\n{pload}")
 
     state.messages[-1][-1] = "▌"
@@ -228,20 +233,19 @@ def http_bot(state, model_selector, temperature, max_new_tokens, request: gr.Req
         # Stream output
         response = requests.post(worker_addr + "/worker_generate_stream",
             headers=headers, json=pload, stream=True, timeout=20)
-        for chunk in response.iter_lines(decode_unicode=False, delimiter=b"\0"):
-            if chunk:
-                data = json.loads(chunk.decode())
-                if data["error_code"] == 0:
-                    output = data["text"][skip_echo_len:].strip()
-                    output = post_process_code(output)
-                    state.messages[-1][-1] = output + "▌"
-                    yield (state, state.to_gradio_chatbot()) + (disable_btn,) * 5
-                else:
-                    output = data["text"] + f" (error_code: {data['error_code']})"
-                    state.messages[-1][-1] = output
-                    yield (state, state.to_gradio_chatbot()) + (disable_btn, disable_btn, disable_btn, enable_btn, enable_btn)
-                    return
-                time.sleep(0.02)
+        generated = ""
+        for data in iter_frames(response):
+            if data["error_code"] == 0:
+                generated += data["text"]
+                output = post_process_code(generated.strip())
+                state.messages[-1][-1] = output + "▌"
+                yield (state, state.to_gradio_chatbot()) + (disable_btn,) * 5
+            else:
+                output = data["text"] + f" (error_code: {data['error_code']})"
+                state.messages[-1][-1] = output
+                yield (state, state.to_gradio_chatbot()) + (disable_btn, disable_btn, disable_btn, enable_btn, enable_btn)
+                return
+            time.sleep(0.02)
     except requests.exceptions.RequestException as e:
         state.messages[-1][-1] = server_error_msg + f" (error_code: 4)"
         yield (state, state.to_gradio_chatbot()) + (disable_btn, disable_btn, disable_btn, enable_btn, enable_btn)
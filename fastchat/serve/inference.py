@@ -1,5 +1,6 @@
 """Inference for FastChat models."""
 import abc
+import functools
 from typing import Optional
 import warnings
 
@@ -10,9 +11,20 @@ except ImportError:
     from transformers import AutoTokenizer, AutoModelForCausalLM, LLaMATokenizer, LLamaForCausalLM, AutoModel
 
 from fastchat.conversation import conv_templates, get_default_conv_template, SeparatorStyle
-from fastchat.serve.compression import compress_module
+from fastchat.model.compress_model import (is_compressed_checkpoint,
+    load_compressed_model, load_and_compress_model)
+from fastchat.serve.compression import compress_module, default_compression_config
+from fastchat.serve.detokenizer import IncrementalDetokenizer
+from fastchat.serve.kv_cache import (StaticKVCache, fit_kv_in_context,
+    supports_static_kv_cache, replace_llama_attn_with_static_kv_cache)
 from fastchat.serve.monkey_patch_non_inplace import replace_llama_attn_with_non_inplace_operations
+from fastchat.serve.paged_kv_cache import PagedKVCache
+from fastchat.serve.parallel_sampling import get_num_samples, parallel_generate_stream
+from fastchat.serve.prefix_cache import lookup_prefix
+from fastchat.serve.sampling import LogitsProcessor, SamplingParams
 from fastchat.serve.serve_chatglm import chatglm_generate_stream
+from fastchat.serve.speculative import speculative_generate_stream, SpeculativeStats
+from fastchat.serve.stop_matcher import StopMatcher
 
 
 def raise_warning_for_old_weights(model_path, model):
@@ -47,11 +59,13 @@ def compute_skip_echo_len(model_name, conv, prompt):
 
 
 def load_model(model_path, device, num_gpus, max_gpu_memory="13GiB",
-               load_8bit=False, debug=False):
+               load_8bit=False, debug=False, compression_config=None):
     if device == "cpu":
         kwargs = {}
+        replace_llama_attn_with_static_kv_cache()
     elif device == "cuda":
         kwargs = {"torch_dtype": torch.float16}
+        replace_llama_attn_with_static_kv_cache()
         if num_gpus == "auto":
             kwargs["device_map"] = "auto"
         else:
@@ -77,14 +91,30 @@ def load_model(model_path, device, num_gpus, max_gpu_memory="13GiB",
         # 50277 means "### End"
         tokenizer.eos_token_id = 50277
         model = AutoModelForCausalLM.from_pretrained(model_path, low_cpu_mem_usage=True, **kwargs)
+    elif is_compressed_checkpoint(model_path):
+        tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=False)
+        model = load_compressed_model(model_path, device,
+            kwargs.get("torch_dtype", torch.float32))
+        # The model is already compressed and on the device.
+        return model, tokenizer
+    elif (compression_config is not None or load_8bit) and "device_map" not in kwargs:
+        # Compress the weights while loading them to bound the peak memory.
+        tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=False)
+        model = load_and_compress_model(model_path, device,
+            compression_config or default_compression_config,
+            kwargs.get("torch_dtype", torch.float32))
+        raise_warning_for_old_weights(model_path, model)
+        return model, tokenizer
     else:
         tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=False)
         model = AutoModelForCausalLM.from_pretrained(model_path,
             low_cpu_mem_usage=True, **kwargs)
         raise_warning_for_old_weights(model_path, model)
 
-    if load_8bit:
-        compress_module(model, device)
+    if compression_config is not None:
+        compress_module(model, device, compression_config)
+    elif load_8bit:
+        compress_module(model, device, default_compression_config)
 
     if (device == "cuda" and num_gpus == 1) or device == "mps":
         model.to(device)
@@ -97,66 +127,146 @@ def load_model(model_path, device, num_gpus, max_gpu_memory="13GiB",
 
 @torch.inference_mode()
 def generate_stream(model, tokenizer, params, device,
-                    context_len=2048, stream_interval=2):
+                    context_len=2048, stream_interval=2, conv_kv_cache=None,
+                    system_prompt_cache=None, draft_model=None,
+                    num_speculative_tokens=4, speculative_stats=None,
+                    quantize_kv_cache=False, kv_block_pool=None,
+                    prefill_chunk_size=None, attention_sinks=None, input_ids=None):
+    """Yield the outputs of a request. `input_ids` are the token ids of the
+    prompt if the caller has already tokenized it."""
+    if get_num_samples(params) != (1, 1):
+        yield from parallel_generate_stream(model, tokenizer, params, device,
+            context_len, stream_interval, prefill_chunk_size, input_ids)
+        return
+    if draft_model is not None:
+        yield from speculative_generate_stream(model, draft_model, tokenizer,
+            params, device, context_len, num_speculative_tokens, speculative_stats,
+            input_ids)
+        return
+
     prompt = params["prompt"]
-    l_prompt = len(prompt)
-    temperature = float(params.get("temperature", 1.0))
+    logits_processor = LogitsProcessor([SamplingParams.from_dict(params)])
     max_new_tokens = int(params.get("max_new_tokens", 256))
-    stop_str = params.get("stop", None)
-    if stop_str == tokenizer.eos_token:
-        stop_str = None
+    stop_matcher = StopMatcher.from_params(params, tokenizer)
+    echo = params.get("echo", True)
+    session_id = params.get("session_id", None)
 
-    input_ids = tokenizer(prompt).input_ids
-    output_ids = list(input_ids)
+    if input_ids is None:
+        input_ids = tokenizer(prompt).input_ids
+    detokenizer = IncrementalDetokenizer(tokenizer, input_ids)
 
     max_src_len = context_len - max_new_tokens - 8
-    input_ids = input_ids[-max_src_len:]
-
-    for i in range(max_new_tokens):
-        if i == 0:
-            out = model(
-                torch.as_tensor([input_ids], device=device), use_cache=True)
-            logits = out.logits
-            past_key_values = out.past_key_values
-        else:
-            out = model(input_ids=torch.as_tensor([[token]], device=device),
-                        use_cache=True,
-                        past_key_values=past_key_values)
+    # Over-length prompts of LLaMA models may keep their first tokens and
+    # evict the middle instead of being cut at the front. If the sinks alone
+    # do not leave room for the prompt, they are cut at the front as well.
+    rolling = (bool(attention_sinks) and kv_block_pool is None and
+               supports_static_kv_cache(model) and max_src_len > attention_sinks)
+    if not rolling:
+        input_ids = input_ids[-max_src_len:]
+    num_yielded = 0
+    num_evicted = 0
+
+    paged_kv_cache = static_kv_cache = None
+    if kv_block_pool is not None and supports_static_kv_cache(model):
+        # Take the blocks of the KV cache from a shared pool. Prefixes are
+        # shared through the pool, so the other prefix caches are not used.
+        paged_kv_cache = PagedKVCache(kv_block_pool)
+        num_cached = paged_kv_cache.match_prefix(input_ids)
+        past_key_values = paged_kv_cache
+        prompt_ids = input_ids[num_cached:]
+    else:
+        # Only prefill the part of the prompt that is not cached from the
+        # previous turn of the conversation or from the system prompt.
+        num_cached, past_key_values = lookup_prefix(
+            input_ids, session_id, conv_kv_cache, system_prompt_cache)
+        prompt_ids = input_ids[num_cached:]
+        if rolling:
+            past_key_values, prompt_ids, num_evicted = fit_kv_in_context(
+                model, input_ids, num_cached, past_key_values,
+                max_src_len, attention_sinks)
+
+        # Write the keys and values into preallocated buffers instead of
+        # concatenating them at every step.
+        if supports_static_kv_cache(model):
+            past_len = past_key_values[0][0].shape[2] if past_key_values is not None else 0
+            static_kv_cache = StaticKVCache.from_model(
+                model, past_len + len(prompt_ids) + max_new_tokens,
+                quantized=quantize_kv_cache)
+            if past_key_values is not None:
+                static_kv_cache.load(past_key_values)
+            past_key_values = static_kv_cache
+
+    def forward(token_ids, past_key_values):
+        if paged_kv_cache is not None:
+            paged_kv_cache.append(token_ids)
+        out = model(torch.as_tensor([token_ids], device=device),
+                    use_cache=True, past_key_values=past_key_values)
+        if paged_kv_cache is not None:
+            paged_kv_cache.commit()
+        return out
+
+    try:
+        for i in range(max_new_tokens):
+            new_ids = prompt_ids if i == 0 else [token]
+            if i == 0 and prefill_chunk_size:
+                # Prefill a long prompt in chunks, so that the forward passes
+                # of other requests can run in between.
+                while len(new_ids) > prefill_chunk_size:
+                    past_key_values = forward(
+                        new_ids[:prefill_chunk_size], past_key_values).past_key_values
+                    new_ids = new_ids[prefill_chunk_size:]
+            out = forward(new_ids, past_key_values)
             logits = out.logits
             past_key_values = out.past_key_values
 
-        last_token_logits = logits[0][-1]
-
-        if device == "mps":
-            # Switch to CPU by avoiding some bugs in mps backend.
-            last_token_logits = last_token_logits.float().to("cpu")
-
-        if temperature < 1e-4:
-            token = int(torch.argmax(last_token_logits))
-        else:
-            probs = torch.softmax(last_token_logits / temperature, dim=-1)
-            token = int(torch.multinomial(probs, num_samples=1))
-
-        output_ids.append(token)
-
-        if token == tokenizer.eos_token_id:
-            stopped = True
-        else:
-            stopped = False
-
-        if i % stream_interval == 0 or i == max_new_tokens - 1 or stopped:
-            output = tokenizer.decode(output_ids, skip_special_tokens=True)
-            if stop_str:
-                pos = output.rfind(stop_str, l_prompt)
-                if pos != -1:
-                    output = output[:pos]
-                    stopped = True
-            yield output
-
-        if stopped:
-            break
-
-    del past_key_values
+            last_token_logits = logits[:, -1]
+
+            if device == "mps":
+                # Switch to CPU by avoiding some bugs in mps backend.
+                last_token_logits = last_token_logits.float().to("cpu")
+
+            token = logits_processor.sample(
+                last_token_logits, [input_ids], [detokenizer.output_ids])[0]
+
+            # The length of the output to keep if a stop token or string ends here.
+            stop_pos = stop_matcher.update(token, detokenizer.add_tokens([token]))
+            stopped = stop_pos is not None
+
+            if i % stream_interval == 0 or i == max_new_tokens - 1 or stopped:
+                output = detokenizer.output[:stop_pos]
+                if stopped:
+                    finish_reason = "stop"
+                elif i == max_new_tokens - 1:
+                    finish_reason = "length"
+                else:
+                    finish_reason = None
+                yield {
+                    "text": detokenizer.prompt_text + output if echo else output,
+                    "token_ids": detokenizer.output_ids[num_yielded:],
+                    "usage": {
+                        "prompt_tokens": len(input_ids),
+                        "completion_tokens": i + 1,
+                        "total_tokens": len(input_ids) + i + 1,
+                    },
+                    "finish_reason": finish_reason,
+                }
+                num_yielded = i + 1
+
+            if stopped:
+                break
+    finally:
+        if paged_kv_cache is not None:
+            # The blocks stay cached for later requests until evicted.
+            paged_kv_cache.free()
+
+    if conv_kv_cache is not None and paged_kv_cache is None:
+        if static_kv_cache is not None:
+            past_key_values = static_kv_cache.to_past()
+        # The last sampled token has not been fed to the model.
+        conv_kv_cache.put(session_id,
+            input_ids + detokenizer.output_ids[:-1], past_key_values,
+            attention_sinks or 0, num_evicted)
+    del past_key_values, static_kv_cache, paged_kv_cache
 
 
 class ChatIO(abc.ABC):
@@ -169,7 +279,7 @@ class ChatIO(abc.ABC):
         """Prompt for output from a role."""
 
     @abc.abstractmethod
-    def stream_output(self, output_stream, skip_echo_len: int):
+    def stream_output(self, output_stream):
         """Stream output."""
 
 
@@ -177,11 +287,17 @@ def chat_loop(model_path: str, device: str, num_gpus: str,
               max_gpu_memory: str, load_8bit: bool,
               conv_template: Optional[str], temperature: float,
               max_new_tokens: int, chatio: ChatIO,
-              debug: bool):
+              debug: bool, draft_model_path: Optional[str] = None,
+              num_speculative_tokens: int = 4, compression_config=None):
     # Model
     model, tokenizer = load_model(model_path, device,
-        num_gpus, max_gpu_memory, load_8bit, debug)
+        num_gpus, max_gpu_memory, load_8bit, debug, compression_config)
     is_chatglm = "chatglm" in str(type(model)).lower()
+    draft_model = None
+    if draft_model_path and not is_chatglm:
+        draft_model, _ = load_model(draft_model_path, device,
+            num_gpus, max_gpu_memory, load_8bit, debug, compression_config)
+    speculative_stats = SpeculativeStats()
 
     # Chat
     if conv_template:
@@ -205,24 +321,28 @@ def chat_loop(model_path: str, device: str, num_gpus: str,
             prompt = conv.messages[conv.offset:]
             generate_stream_func = chatglm_generate_stream
         else:
-            generate_stream_func = generate_stream
+            generate_stream_func = functools.partial(generate_stream,
+                draft_model=draft_model,
+                num_speculative_tokens=num_speculative_tokens,
+                speculative_stats=speculative_stats)
             prompt = conv.get_prompt()
 
-        skip_echo_len = compute_skip_echo_len(model_path, conv, prompt)
-
         params = {
             "model": model_path,
             "prompt": prompt,
             "temperature": temperature,
             "max_new_tokens": max_new_tokens,
             "stop": conv.sep if conv.sep_style == SeparatorStyle.SINGLE else conv.sep2,
+            "echo": False,
         }
 
         chatio.prompt_for_output(conv.roles[1])
         output_stream = generate_stream_func(model, tokenizer, params, device)
-        outputs = chatio.stream_output(output_stream, skip_echo_len)
+        outputs = chatio.stream_output(output_stream)
         # NOTE: strip is important to align with the training data.
         conv.messages[-1][-1] = outputs.strip()
 
         if debug:
             print("\n", {"prompt": prompt, "outputs": outputs}, "\n")
+            if draft_model is not None:
+                print(f"Acceptance rate: {speculative_stats.acceptance_rate:.2f}\n")
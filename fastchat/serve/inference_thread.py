@@ -0,0 +1,81 @@
+"""
+A dedicated thread that runs all generate functions of a model.
+
+A sync generator served by a StreamingResponse is advanced on Starlette's
+threadpool, so every output of a request may come from a different pool
+thread and concurrent requests call the model from arbitrary threads.
+Instead, requests are submitted to one thread through a queue. The thread
+advances the generators of all active requests in round-robin order, one
+output at a time, and hands the outputs to the event loop through an
+asyncio queue per request.
+"""
+import asyncio
+import dataclasses
+import queue
+import threading
+from typing import Any, Callable, Optional
+
+
+class _End:
+    pass
+
+
+@dataclasses.dataclass
+class InferenceJob:
+    make_generator: Callable
+    loop: asyncio.AbstractEventLoop
+    outputs: asyncio.Queue
+    generator: Optional[Any] = None
+    # Set by the event loop when the client is gone.
+    cancelled: bool = False
+
+    def send(self, item):
+        self.loop.call_soon_threadsafe(self.outputs.put_nowait, item)
+
+
+class InferenceThread:
+    def __init__(self):
+        self.jobs = queue.Queue()
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    async def stream(self, make_generator: Callable):
+        """Run `make_generator()` on the inference thread and yield its outputs."""
+        job = InferenceJob(make_generator, asyncio.get_running_loop(), asyncio.Queue())
+        self.jobs.put(job)
+        try:
+            while True:
+                item = await job.outputs.get()
+                if isinstance(item, _End):
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            job.cancelled = True
+
+    def loop(self):
+        active = []
+        while True:
+            if not active:
+                active.append(self.jobs.get())
+            while not self.jobs.empty():
+                active.append(self.jobs.get_nowait())
+
+            for job in list(active):
+                if job.cancelled:
+                    # Run the cleanup of the generator on this thread.
+                    if job.generator is not None:
+                        job.generator.close()
+                    active.remove(job)
+                    continue
+                try:
+                    if job.generator is None:
+                        job.generator = job.make_generator()
+                    job.send(next(job.generator))
+                except StopIteration:
+                    job.send(_End())
+                    active.remove(job)
+                except Exception as e:
+                    job.send(e)
+                    active.remove(job)
@@ -0,0 +1,309 @@
+"""
+A preallocated KV cache for LLaMA models.
+
+The huggingface implementation grows the past key values with `torch.cat` at
+every step, which reallocates and copies the whole cache of every layer for
+every generated token. A static cache allocates the buffers once per request
+and writes the new keys and values into the next free slots in place.
+Optionally, the keys and values are stored in int8 with a scale per head
+and token, which halves the memory of an fp16 cache.
+
+For conversations longer than the context, evict_kv drops positions from
+the middle of a cache and keeps the first (attention sink) positions and the
+most recent ones.
+"""
+import math
+from typing import Optional, Tuple
+
+import torch
+from torch import nn
+import transformers
+from transformers.models.llama.modeling_llama import apply_rotary_pos_emb, rotate_half
+
+from fastchat.serve.compression import CompressionConfig, compress, decompress
+
+
+class StaticKVLayer:
+    """The preallocated key and value buffers of one attention layer.
+
+    It looks like the (key, value) tuple of a huggingface cache: indexing it
+    returns views of the filled part of the buffers, so that code reading
+    `past_key_value[0].shape[2]` gets the current length.
+    """
+
+    def __init__(self, key: torch.Tensor, value: torch.Tensor):
+        # [batch, heads, max_len, head_dim]
+        self.key = key
+        self.value = value
+        self.length = 0
+
+    def __getitem__(self, i):
+        return (self.key, self.value)[i][:, :, :self.length]
+
+    def __len__(self):
+        return 2
+
+    def __iter__(self):
+        return iter((self[0], self[1]))
+
+    def update(self, key_states, value_states):
+        """Write new keys and values into the next slots and return the whole cache."""
+        start, end = self.length, self.length + key_states.shape[2]
+        if end > self.key.shape[2]:
+            raise ValueError(f"The KV cache is full ({self.key.shape[2]} tokens).")
+        self.key[:, :, start:end] = key_states
+        self.value[:, :, start:end] = value_states
+        self.length = end
+        return self[0], self[1]
+
+
+class QuantizedKVLayer(StaticKVLayer):
+    """A StaticKVLayer that stores int8 keys and values.
+
+    Every head of every token is one quantization group with its own scale.
+    Indexing dequantizes the filled part of the buffers. Read `length` to get
+    the length without dequantizing.
+
+    Huggingface reads `past_key_values[0][0].shape[2]` before every forward
+    pass, so the first layer keeps its dequantized keys until the next
+    update instead of dequantizing them again only for their shape.
+    """
+
+    def __init__(self, key, value, key_scale, value_scale, dtype,
+                 keep_dequantized_key: bool = False):
+        # int8 [batch, heads, max_len, 1, head_dim]
+        super().__init__(key, value)
+        # float32 [batch, heads, max_len, 1, 1]
+        self.key_scale = key_scale
+        self.value_scale = value_scale
+        self.dtype = dtype
+        self.config = CompressionConfig(num_bits=8, group_size=key.shape[-1],
+                                        group_dim=3, symmetric=True)
+        self.keep_dequantized_key = keep_dequantized_key
+        # (length, keys) of the last dequantization of the keys.
+        self.dequantized_key = None
+
+    def __getitem__(self, i):
+        if (i == 0 and self.dequantized_key is not None and
+                self.dequantized_key[0] == self.length):
+            return self.dequantized_key[1]
+        data, scale = ((self.key, self.key_scale), (self.value, self.value_scale))[i]
+        shape = torch.Size(data.shape[:2] + (self.length, data.shape[-1]))
+        packed_data = (data[:, :, :self.length], scale[:, :, :self.length], shape)
+        output = decompress(packed_data, self.config).to(self.dtype)
+        if i == 0 and self.keep_dequantized_key:
+            self.dequantized_key = (self.length, output)
+        return output
+
+    def update(self, key_states, value_states):
+        start, end = self.length, self.length + key_states.shape[2]
+        if end > self.key.shape[2]:
+            raise ValueError(f"The KV cache is full ({self.key.shape[2]} tokens).")
+        for data, scale, states in ((self.key, self.key_scale, key_states),
+                                    (self.value, self.value_scale, value_states)):
+            new_data, new_scale, _ = compress(states.float(), self.config)
+            data[:, :, start:end] = new_data
+            scale[:, :, start:end] = new_scale
+        self.length = end
+        self.dequantized_key = None
+        return self[0], self[1]
+
+
+class StaticKVCache:
+    """The static KV caches of all layers of a model."""
+
+    def __init__(self, layers):
+        self.layers = layers
+
+    @classmethod
+    def from_model(cls, model, max_len: int, batch_size: int = 1,
+                   quantized: bool = False):
+        config = model.config
+        num_heads = config.num_attention_heads
+        head_dim = config.hidden_size // num_heads
+        layers = []
+        for decoder_layer in model.model.layers:
+            # The weights of the linear layers may be compressed, so take the
+            # device and dtype from the layer norm.
+            weight = decoder_layer.input_layernorm.weight
+            if quantized:
+                keep_dequantized_key = not layers
+                shape = (batch_size, num_heads, max_len, 1, head_dim)
+                scale_shape = (batch_size, num_heads, max_len, 1, 1)
+                layers.append(QuantizedKVLayer(
+                    torch.empty(shape, dtype=torch.int8, device=weight.device),
+                    torch.empty(shape, dtype=torch.int8, device=weight.device),
+                    torch.empty(scale_shape, dtype=torch.float32, device=weight.device),
+                    torch.empty(scale_shape, dtype=torch.float32, device=weight.device),
+                    weight.dtype, keep_dequantized_key))
+            else:
+                shape = (batch_size, num_heads, max_len, head_dim)
+                layers.append(StaticKVLayer(
+                    torch.empty(shape, dtype=weight.dtype, device=weight.device),
+                    torch.empty(shape, dtype=weight.dtype, device=weight.device)))
+        return cls(layers)
+
+    def __getitem__(self, i):
+        return self.layers[i]
+
+    def __len__(self):
+        return len(self.layers)
+
+    def __iter__(self):
+        return iter(self.layers)
+
+    def load(self, past_key_values):
+        """Copy the past key values of a cached prefix into the buffers."""
+        for layer, (key, value) in zip(self.layers, past_key_values):
+            layer.length = 0
+            layer.update(key, value)
+
+    def truncate(self, length: int):
+        """Drop all positions from `length` on; they are overwritten later."""
+        for layer in self.layers:
+            layer.length = min(layer.length, length)
+
+    def nbytes(self):
+        return sum(x.numel() * x.element_size() for layer in self.layers
+                   for x in vars(layer).values() if isinstance(x, torch.Tensor))
+
+    def to_past(self):
+        """Return a copy of the cache as huggingface past key values."""
+        return tuple((layer[0].clone(), layer[1].clone()) for layer in self.layers)
+
+
+@torch.inference_mode()
+def evict_kv(model, past_key_values, num_sinks: int, num_evict: int):
+    """Drop `num_evict` positions after the first `num_sinks` ones from LLaMA
+    past key values.
+
+    The keys are cached with their rotary position embedding applied. The
+    keys after the dropped positions are rotated back by `num_evict`
+    positions, so that the positions of the cache stay contiguous and new
+    tokens continue right after them.
+    """
+    new_past = []
+    for decoder_layer, (key, value) in zip(model.model.layers, past_key_values):
+        start, end = num_sinks, num_sinks + num_evict
+        cos, sin = decoder_layer.self_attn.rotary_emb(value, seq_len=num_evict + 1)
+        cos = cos[:, :, num_evict:].float()
+        sin = sin[:, :, num_evict:].float()
+        kept = key[:, :, end:].float()
+        # Rotating by -num_evict positions is cos(-x) = cos(x), sin(-x) = -sin(x).
+        kept = (kept * cos - rotate_half(kept) * sin).to(key.dtype)
+        new_past.append((torch.cat([key[:, :, :start], kept], dim=2),
+                         torch.cat([value[:, :, :start], value[:, :, end:]], dim=2)))
+    return tuple(new_past)
+
+
+def fit_kv_in_context(model, input_ids, num_cached, past_key_values,
+                      max_len: int, num_sinks: int):
+    """Evict positions after the first `num_sinks` ones, so that the cached
+    prefix and the rest of the prompt take at most `max_len` positions.
+
+    The oldest cached positions are evicted first, then the oldest prompt
+    tokens that are not cached. The sinks and one prompt token are always
+    kept, so the result only fits if `max_len > num_sinks`. Return the new
+    past key values, the prompt tokens to prefill and the total number of
+    evicted positions.
+    """
+    kv_len = past_key_values[0][0].shape[2] if past_key_values is not None else 0
+    num_evicted = num_cached - kv_len
+    prompt_ids = input_ids[num_cached:]
+    overflow = kv_len + len(prompt_ids) - max_len
+
+    n = min(overflow, kv_len - num_sinks)
+    if n > 0:
+        past_key_values = evict_kv(model, past_key_values, num_sinks, n)
+        num_evicted += n
+        overflow -= n
+    if overflow > 0:
+        start = max(num_sinks - num_cached, 0)
+        # Keep at least one token to compute the next-token logits.
+        overflow = max(min(overflow, len(prompt_ids) - start - 1), 0)
+        prompt_ids = prompt_ids[:start] + prompt_ids[start + overflow:]
+        num_evicted += overflow
+    return past_key_values, prompt_ids, num_evicted
+
+
+def supports_static_kv_cache(model):
+    return (isinstance(model, transformers.LlamaForCausalLM) and
+            transformers.models.llama.modeling_llama.LlamaAttention.forward is forward)
+
+
+def forward(
+    self,
+    hidden_states: torch.Tensor,
+    attention_mask: Optional[torch.Tensor] = None,
+    position_ids: Optional[torch.LongTensor] = None,
+    past_key_value: Optional[Tuple[torch.Tensor]] = None,
+    output_attentions: bool = False,
+    use_cache: bool = False,
+) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Tuple[torch.Tensor]]]:
+    bsz, q_len, _ = hidden_states.size()
+
+    query_states = self.q_proj(hidden_states).view(bsz, q_len, self.num_heads, self.head_dim).transpose(1, 2)
+    key_states = self.k_proj(hidden_states).view(bsz, q_len, self.num_heads, self.head_dim).transpose(1, 2)
+    value_states = self.v_proj(hidden_states).view(bsz, q_len, self.num_heads, self.head_dim).transpose(1, 2)
+
+    kv_seq_len = key_states.shape[-2]
+    if isinstance(past_key_value, StaticKVLayer):
+        # Do not dequantize a QuantizedKVLayer only to get its length.
+        kv_seq_len += past_key_value.length
+    elif past_key_value is not None:
+        kv_seq_len += past_key_value[0].shape[-2]
+    cos, sin = self.rotary_emb(value_states, seq_len=kv_seq_len)
+    query_states, key_states = apply_rotary_pos_emb(query_states, key_states, cos, sin, position_ids)
+    # [bsz, nh, t, hd]
+
+    if isinstance(past_key_value, StaticKVLayer):
+        # write k, v into the preallocated cache in place
+        key_states, value_states = past_key_value.update(key_states, value_states)
+        past_key_value = past_key_value if use_cache else None
+    else:
+        if past_key_value is not None:
+            # reuse k, v, self_attention
+            key_states = torch.cat([past_key_value[0], key_states], dim=2)
+            value_states = torch.cat([past_key_value[1], value_states], dim=2)
+        past_key_value = (key_states, value_states) if use_cache else None
+
+    attn_weights = torch.matmul(query_states, key_states.transpose(2, 3)) / math.sqrt(self.head_dim)
+
+    if attn_weights.size() != (bsz, self.num_heads, q_len, kv_seq_len):
+        raise ValueError(
+            f"Attention weights should be of size {(bsz * self.num_heads, q_len, kv_seq_len)}, but is"
+            f" {attn_weights.size()}"
+        )
+
+    if attention_mask is not None:
+        if attention_mask.size() != (bsz, 1, q_len, kv_seq_len):
+            raise ValueError(
+                f"Attention mask should be of size {(bsz, 1, q_len, kv_seq_len)}, but is {attention_mask.size()}"
+            )
+        attn_weights = attn_weights + attention_mask
+        attn_weights = torch.max(attn_weights, torch.tensor(torch.finfo(attn_weights.dtype).min))
+
+    # upcast attention to fp32
+    attn_weights = nn.functional.softmax(attn_weights, dim=-1, dtype=torch.float32).to(query_states.dtype)
+    attn_output = torch.matmul(attn_weights, value_states)
+
+    if attn_output.size() != (bsz, self.num_heads, q_len, self.head_dim):
+        raise ValueError(
+            f"`attn_output` should be of size {(bsz, self.num_heads, q_len, self.head_dim)}, but is"
+            f" {attn_output.size()}"
+        )
+
+    attn_output = attn_output.transpose(1, 2)
+    attn_output = attn_output.reshape(bsz, q_len, self.hidden_size)
+
+    attn_output = self.o_proj(attn_output)
+
+    if not output_attentions:
+        attn_weights = None
+
+    return attn_output, attn_weights, past_key_value
+
+
+def replace_llama_attn_with_static_kv_cache():
+    """Let the llama attention write into a StaticKVCache in place."""
+    transformers.models.llama.modeling_llama.LlamaAttention.forward = forward
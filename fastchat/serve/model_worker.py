@@ -4,6 +4,7 @@ A model worker executes the model.
 import argparse
 import asyncio
 import dataclasses
+import functools
 import logging
 import json
 import time
@@ -22,10 +23,23 @@ import torch
 import uvicorn
 
 from fastchat.constants import WORKER_HEART_BEAT_INTERVAL
+from fastchat.conversation import conv_templates
+from fastchat.serve.admission import TokenBudget, kv_bytes_per_token
+from fastchat.serve.batching import ContinuousBatchingEngine
+from fastchat.serve.compression import add_compression_args, get_compression_config
 from fastchat.serve.inference import load_model, generate_stream
-from fastchat.serve.serve_chatglm import chatglm_generate_stream
-from fastchat.utils import (build_logger, server_error_msg,
-    pretty_print_semaphore)
+from fastchat.serve.inference_thread import InferenceThread
+from fastchat.serve.kv_cache import supports_static_kv_cache
+from fastchat.serve.paged_kv_cache import KVBlockPool, OutOfKVBlocksError
+from fastchat.serve.parallel_sampling import get_num_samples
+from fastchat.serve.prefix_cache import ConversationKVCache, SystemPromptCache
+from fastchat.serve.response_cache import ResponseCache, response_cache_key
+from fastchat.serve.speculative import SpeculativeStats
+from fastchat.serve.serve_chatglm import chatglm_generate_stream, chatglm_prompt
+from fastchat.serve.stop_matcher import get_stop_strs
+from fastchat.serve.stream_protocol import (STREAM_PROTOCOL_DELTA,
+    DeltaEncoder, encode_frame)
+from fastchat.utils import build_logger, server_error_msg
 
 GB = 1 << 30
 
@@ -33,8 +47,6 @@ worker_id = str(uuid.uuid4())[:6]
 logger = build_logger("model_worker", f"model_worker_{worker_id}.log")
 global_counter = 0
 
-model_semaphore = None
-
 
 def heart_beat_worker(controller):
 
@@ -46,7 +58,16 @@ def heart_beat_worker(controller):
 class ModelWorker:
     def __init__(self, controller_addr, worker_addr,
                  worker_id, no_register, model_path, model_name,
-                 device, num_gpus, max_gpu_memory, load_8bit=False):
+                 device, num_gpus, max_gpu_memory, load_8bit=False,
+                 continuous_batching=False, max_batch_size=8,
+                 conv_kv_cache_gb=0, system_prompt_cache=False,
+                 draft_model_path=None, num_speculative_tokens=4,
+                 compression_config=None, quantize_kv_cache=False,
+                 paged_kv_cache_gb=0, kv_block_size=16,
+                 limit_model_concurrency=5, kv_cache_budget_gb=0,
+                 prefill_chunk_size=None, attention_sinks=None,
+                 response_cache_gb=0, response_cache_ttl=3600,
+                 response_cache_dir=None, response_cache_disk_gb=10):
         self.controller_addr = controller_addr
         self.worker_addr = worker_addr
         self.worker_id = worker_id
@@ -57,7 +78,8 @@ class ModelWorker:
 
         logger.info(f"Loading the model {self.model_name} on worker {worker_id} ...")
         self.model, self.tokenizer = load_model(
-            model_path, device, num_gpus, max_gpu_memory, load_8bit)
+            model_path, device, num_gpus, max_gpu_memory, load_8bit,
+            compression_config=compression_config)
 
         if hasattr(self.model.config, "max_sequence_length"):
             self.context_len = self.model.config.max_sequence_length
@@ -67,10 +89,73 @@ class ModelWorker:
             self.context_len = 2048
 
         is_chatglm = "chatglm" in str(type(self.model)).lower()
+        self.is_chatglm = is_chatglm
+        self.conv_kv_cache = None
+        if conv_kv_cache_gb > 0 and not is_chatglm:
+            self.conv_kv_cache = ConversationKVCache(int(conv_kv_cache_gb * GB))
+        self.system_prompt_cache = None
+        if system_prompt_cache and not is_chatglm:
+            logger.info("Precompute the KV cache of the system prompts ...")
+            self.system_prompt_cache = SystemPromptCache.from_templates(
+                self.model, self.tokenizer, device, conv_templates.values())
+
+        self.kv_block_pool = None
+        if paged_kv_cache_gb > 0 and supports_static_kv_cache(self.model):
+            self.kv_block_pool = KVBlockPool.from_memory(
+                self.model, int(paged_kv_cache_gb * GB), kv_block_size)
+            logger.info(f"Allocated {self.kv_block_pool.num_blocks} KV cache blocks "
+                        f"of {kv_block_size} tokens.")
+
+        # Admit requests by the KV cache they need. With a paged KV cache,
+        # the budget is the pool of blocks.
+        max_tokens = None
+        if self.kv_block_pool is not None:
+            max_tokens = self.kv_block_pool.num_blocks * self.kv_block_pool.block_size
+        elif kv_cache_budget_gb > 0:
+            max_tokens = int(kv_cache_budget_gb * GB) // kv_bytes_per_token(self.model)
+        self.token_budget = TokenBudget(max_tokens, limit_model_concurrency,
+                                        self.context_len)
+
+        self.response_cache = None
+        if response_cache_gb > 0 or response_cache_dir:
+            self.response_cache = ResponseCache(int(response_cache_gb * GB),
+                response_cache_ttl, response_cache_dir, int(response_cache_disk_gb * GB))
+
+        self.draft_model = None
+        self.speculative_stats = SpeculativeStats()
+        if draft_model_path and not is_chatglm:
+            logger.info(f"Loading the draft model {draft_model_path} ...")
+            self.draft_model, _ = load_model(
+                draft_model_path, device, num_gpus, max_gpu_memory, load_8bit,
+                compression_config=compression_config)
+
         if is_chatglm:
             self.generate_stream_func = chatglm_generate_stream
+        elif self.draft_model is not None:
+            self.generate_stream_func = functools.partial(
+                generate_stream, draft_model=self.draft_model,
+                num_speculative_tokens=num_speculative_tokens,
+                speculative_stats=self.speculative_stats)
+        else:
+            self.generate_stream_func = functools.partial(
+                generate_stream, conv_kv_cache=self.conv_kv_cache,
+                system_prompt_cache=self.system_prompt_cache,
+                quantize_kv_cache=quantize_kv_cache,
+                kv_block_pool=self.kv_block_pool,
+                prefill_chunk_size=prefill_chunk_size,
+                attention_sinks=attention_sinks)
+
+        # All forward passes run on one thread: the thread of the continuous
+        # batching engine, or else an inference thread that interleaves the
+        # generate functions of the requests.
+        self.engine = self.inference_thread = None
+        if continuous_batching and not is_chatglm and self.draft_model is None:
+            self.engine = ContinuousBatchingEngine(
+                self.model, self.tokenizer, device, self.context_len,
+                args.stream_interval, max_batch_size, self.conv_kv_cache,
+                self.system_prompt_cache, prefill_chunk_size)
         else:
-            self.generate_stream_func = generate_stream
+            self.inference_thread = InferenceThread()
 
         if not no_register:
             self.register_to_controller()
@@ -92,8 +177,18 @@ class ModelWorker:
 
     def send_heart_beat(self):
         logger.info(f"Send heart beat. Models: {[self.model_name]}. "
-                    f"Semaphore: {pretty_print_semaphore(model_semaphore)}. "
+                    f"Budget: {self.token_budget}. "
                     f"global_counter: {global_counter}")
+        if self.draft_model is not None:
+            logger.info(f"Speculative decoding acceptance rate: "
+                        f"{self.speculative_stats.acceptance_rate:.2f} "
+                        f"({self.speculative_stats.num_accepted}/"
+                        f"{self.speculative_stats.num_proposed})")
+        if self.kv_block_pool is not None:
+            logger.info(f"Free KV cache blocks: {self.get_num_free_kv_blocks()}"
+                        f"/{self.kv_block_pool.num_blocks}")
+        if self.response_cache is not None:
+            logger.info(f"Response cache: {self.response_cache}")
 
         url = self.controller_addr + "/receive_heart_beat"
 
@@ -101,7 +196,8 @@ class ModelWorker:
             try:
                 ret = requests.post(url, json={
                     "worker_name": self.worker_addr,
-                    "queue_length": self.get_queue_length()}, timeout=5)
+                    "queue_length": self.get_queue_length(),
+                    "num_requests": self.token_budget.num_requests()}, timeout=5)
                 exist = ret.json()["exist"]
                 break
             except requests.exceptions.RequestException as e:
@@ -111,56 +207,212 @@ class ModelWorker:
         if not exist:
             self.register_to_controller()
 
+    def report_request_done(self, dispatch_id):
+        url = self.controller_addr + "/receive_request_done"
+        try:
+            requests.post(url, json={
+                "worker_name": self.worker_addr,
+                "dispatch_id": dispatch_id}, timeout=5)
+        except requests.exceptions.RequestException as e:
+            logger.error(f"report request done error: {e}")
+
     def get_queue_length(self):
-        if model_semaphore is None or model_semaphore._value is None or model_semaphore._waiters is None:
-            return 0
-        else:
-            return args.limit_model_concurrency - model_semaphore._value + len(
-                model_semaphore._waiters)
+        """The tokens of running and queued requests, in units of the context length."""
+        return self.token_budget.load()
+
+    def tokenize(self, prompt):
+        """The token ids of a prompt. The prompt of ChatGLM is a list of
+        messages, which is tokenized as the text that the model sees."""
+        if self.is_chatglm:
+            prompt = chatglm_prompt(prompt)
+        return self.tokenizer(prompt).input_ids
+
+    def estimate_num_tokens(self, params, input_ids):
+        """The prompt tokens plus max_new_tokens, the largest KV cache of a request.
+
+        Every sample of a request with `best_of` samples has its own copy.
+        """
+        max_new_tokens = int(params.get("max_new_tokens", 256))
+        max_src_len = self.context_len - max_new_tokens - 8
+        num_tokens = min(len(input_ids), max(max_src_len, 0)) + max_new_tokens
+        if self.kv_block_pool is not None:
+            pool = self.kv_block_pool
+            num_tokens = pool.num_blocks_needed(num_tokens) * pool.block_size
+        return num_tokens * get_num_samples(params)[1]
+
+    def get_response_cache_key(self, params, input_ids):
+        """The response cache key of a request, or None if it is not cached."""
+        if self.response_cache is None or self.is_chatglm:
+            return None
+        return response_cache_key(self.model_name, input_ids, params)
+
+    def get_num_free_kv_blocks(self):
+        if self.kv_block_pool is None:
+            return None
+        return self.kv_block_pool.num_free_blocks()
 
     def get_status(self):
-        return {
+        status = {
             "model_names": [self.model_name],
             "speed": 1,
             "queue_length": self.get_queue_length(),
+            "num_requests": self.token_budget.num_requests(),
         }
+        if self.kv_block_pool is not None:
+            status["num_free_kv_blocks"] = self.get_num_free_kv_blocks()
+            status["num_kv_blocks"] = self.kv_block_pool.num_blocks
+        return status
+
+    async def generate_stream_gate(self, params, input_ids):
+        delta = params.get("stream_protocol") == STREAM_PROTOCOL_DELTA
+        if delta:
+            params["echo"] = False
+            stop_strs = get_stop_strs(params, self.tokenizer.eos_token)
+            # One encoder per sample; the index is None for a single sample.
+            encoders = {}
+            finished = set()
+
+        if self.engine is not None:
+            output_stream = self.engine.generate_stream(params, input_ids)
+        else:
+            # ChatGLM tokenizes the messages itself.
+            kwargs = {} if self.is_chatglm else {"input_ids": input_ids}
+            output_stream = self.inference_thread.stream(functools.partial(
+                self.generate_stream_func, self.model, self.tokenizer,
+                params, self.device, self.context_len, args.stream_interval,
+                **kwargs))
 
-    def generate_stream_gate(self, params):
         try:
-            for output in self.generate_stream_func(self.model, self.tokenizer,
-                    params, self.device, self.context_len, args.stream_interval):
-                ret = {
-                    "text": output,
-                    "error_code": 0,
-                }
-                yield json.dumps(ret).encode() + b"\0"
-        except torch.cuda.OutOfMemoryError:
+            async for output in output_stream:
+                index = output.get("index", None)
+                if delta:
+                    if index not in encoders:
+                        encoders[index] = DeltaEncoder(stop_strs)
+                    ret = encoders[index].update(output)
+                    if output.get("finish_reason", None) is not None:
+                        ret = encoders[index].finish()
+                        finished.add(index)
+                else:
+                    ret = {
+                        "text": output["text"],
+                        "error_code": 0,
+                    }
+                if ret is not None:
+                    if index is not None:
+                        ret["index"] = index
+                    yield encode_frame(ret)
+            if delta:
+                if not encoders:
+                    encoders[None] = DeltaEncoder(stop_strs)
+                for index, encoder in encoders.items():
+                    if index not in finished:
+                        ret = encoder.finish()
+                        if index is not None:
+                            ret["index"] = index
+                        yield encode_frame(ret)
+        except (torch.cuda.OutOfMemoryError, OutOfKVBlocksError):
             ret = {
                 "text": server_error_msg,
                 "error_code": 1,
             }
-            yield json.dumps(ret).encode() + b"\0"
+            yield encode_frame(ret)
+        finally:
+            # Stop the generation if the client is gone.
+            await output_stream.aclose()
 
 
 app = FastAPI()
+background_generations = set()
+
+
+async def release_token_budget(num_tokens):
+    worker.token_budget.release(num_tokens)
 
 
-def release_model_semaphore():
-    model_semaphore.release()
+async def error_stream(text, error_code):
+    yield encode_frame({"text": text, "error_code": error_code})
+
+
+async def replay_stream(frames):
+    for frame in frames:
+        yield frame
+
+
+async def generate_cached_stream(key, params, input_ids, num_tokens):
+    """Follow the identical request in flight, or generate the stream in a
+    background task, so that it is completed and cached even if the client
+    disconnects."""
+    cache = worker.response_cache
+    response, is_new = cache.start(key)
+    if not is_new:
+        return response.replay()
+
+    try:
+        await worker.token_budget.acquire(num_tokens)
+    except asyncio.CancelledError:
+        response.append(encode_frame({"text": server_error_msg, "error_code": 1}))
+        await cache.finish(key, response, success=False)
+        raise
+
+    async def produce():
+        try:
+            async for frame in worker.generate_stream_gate(params, input_ids):
+                response.append(frame)
+        except Exception:
+            logger.exception("Error in a cached generation")
+            response.append(encode_frame({"text": server_error_msg, "error_code": 1}))
+        finally:
+            # An error frame is always the last one.
+            success = (bool(response.frames) and
+                       json.loads(response.frames[-1][:-1])["error_code"] == 0)
+            worker.token_budget.release(num_tokens)
+            await cache.finish(key, response, success)
+
+    # Keep a reference, so that the task is not garbage collected.
+    task = asyncio.create_task(produce())
+    background_generations.add(task)
+    task.add_done_callback(background_generations.discard)
+    return response.replay()
 
 
 @app.post("/worker_generate_stream")
 async def api_generate_stream(request: Request):
-    global model_semaphore, global_counter
+    global global_counter
     global_counter += 1
     params = await request.json()
 
-    if model_semaphore is None:
-        model_semaphore = asyncio.Semaphore(args.limit_model_concurrency)
-    await model_semaphore.acquire()
-    generator = worker.generate_stream_gate(params)
     background_tasks = BackgroundTasks()
-    background_tasks.add_task(release_model_semaphore)
+    # Tokenize a long prompt off the event loop, once for the admission,
+    # the response cache and the generation.
+    input_ids = await asyncio.get_running_loop().run_in_executor(
+        None, worker.tokenize, params["prompt"])
+    try:
+        num_tokens = worker.estimate_num_tokens(params, input_ids)
+    except ValueError as e:
+        # Invalid sampling parameters, e.g. best_of < n.
+        generator = error_stream(str(e), 5)
+    else:
+        cache_key = worker.get_response_cache_key(params, input_ids)
+        cached_frames = None
+        if cache_key is not None:
+            cached_frames = await worker.response_cache.get(cache_key)
+
+        if cached_frames is not None:
+            generator = replay_stream(cached_frames)
+        elif not worker.token_budget.fits(num_tokens):
+            generator = error_stream(
+                f"The request needs a KV cache of {num_tokens} tokens, but "
+                f"this worker has {worker.token_budget.max_tokens}. Please "
+                f"shorten the conversation or lower max_new_tokens.", 4)
+        elif cache_key is not None:
+            generator = await generate_cached_stream(cache_key, params, input_ids,
+                                                     num_tokens)
+        else:
+            await worker.token_budget.acquire(num_tokens)
+            generator = worker.generate_stream_gate(params, input_ids)
+            background_tasks.add_task(release_token_budget, num_tokens)
+    if "dispatch_id" in params:
+        background_tasks.add_task(worker.report_request_done, params["dispatch_id"])
     return StreamingResponse(generator, background=background_tasks)
 
 
@@ -184,10 +436,67 @@ if __name__ == "__main__":
     parser.add_argument("--device", type=str, choices=["cpu", "cuda", "mps"], default="cuda")
     parser.add_argument("--num-gpus", type=int, default=1)
     parser.add_argument("--max-gpu-memory", type=str, default="13GiB")
-    parser.add_argument("--load-8bit", action="store_true")
+    add_compression_args(parser)
     parser.add_argument("--limit-model-concurrency", type=int, default=5)
+    parser.add_argument("--kv-cache-budget-gb", type=float, default=0,
+        help="Admit requests while their prompt tokens plus max_new_tokens "
+             "fit a KV cache of this many GiB, and reject larger requests. "
+             "With --paged-kv-cache-gb, the block pool is the budget. "
+             "0 only limits the number of requests.")
     parser.add_argument("--stream-interval", type=int, default=2)
     parser.add_argument("--no-register", action="store_true")
+    parser.add_argument("--continuous-batching", action="store_true",
+        help="Batch the decode steps of all concurrent requests together.")
+    parser.add_argument("--max-batch-size", type=int, default=8,
+        help="The maximum number of requests in one continuous batch.")
+    parser.add_argument("--prefill-chunk-size", type=int, default=None,
+        help="Prefill long prompts in chunks of this many tokens, so that "
+             "the decode steps of other requests are not stalled by a long "
+             "prefill. With --continuous-batching, at most this many prompt "
+             "tokens are prefilled between two decode steps.")
+    parser.add_argument("--conv-kv-cache-gb", type=float, default=0,
+        help="Keep the KV cache of finished turns, keyed by session id, "
+             "within this many GiB, so that the next turn of a conversation "
+             "only prefills its new tokens. 0 disables it.")
+    parser.add_argument("--attention-sinks", type=int, default=None,
+        help="When a conversation does not fit the context of a LLaMA model, "
+             "keep this many tokens at its start (e.g. the system prompt) and "
+             "the most recent tokens, and evict the middle from the KV cache. "
+             "With --conv-kv-cache-gb, the next turns reuse the evicted cache "
+             "instead of prefilling the truncated conversation again. "
+             "It is not used with --continuous-batching, --draft-model-path "
+             "or --paged-kv-cache-gb.")
+    parser.add_argument("--system-prompt-cache", action="store_true",
+        help="Precompute the KV cache of the system prompt of every "
+             "conversation template and start each prefill from it.")
+    parser.add_argument("--draft-model-path", type=str, default=None,
+        help="A small model with the same tokenizer for speculative decoding. "
+             "It is not used with --continuous-batching.")
+    parser.add_argument("--num-speculative-tokens", type=int, default=4,
+        help="The number of tokens the draft model proposes per step.")
+    parser.add_argument("--quantize-kv-cache", action="store_true",
+        help="Store the KV cache of LLaMA models in int8. "
+             "It is not used with --continuous-batching or --draft-model-path.")
+    parser.add_argument("--paged-kv-cache-gb", type=float, default=0,
+        help="Keep the KV cache of LLaMA models in a pool of blocks of this "
+             "many GiB shared by all requests, which also shares the blocks of "
+             "common prompt prefixes. 0 allocates a cache per request. "
+             "It is not used with --continuous-batching or --draft-model-path.")
+    parser.add_argument("--kv-block-size", type=int, default=16,
+        help="The number of tokens per block of the paged KV cache.")
+    parser.add_argument("--response-cache-gb", type=float, default=0,
+        help="Cache the responses of greedy requests within this many GiB, "
+             "and replay them for requests with the same prompt and "
+             "parameters. Identical concurrent requests share one "
+             "generation. 0 disables the memory cache.")
+    parser.add_argument("--response-cache-ttl", type=float, default=3600,
+        help="The seconds after which a cached response expires.")
+    parser.add_argument("--response-cache-dir", type=str, default=None,
+        help="Also keep the cached responses as files in this directory, "
+             "which survive restarts.")
+    parser.add_argument("--response-cache-disk-gb", type=float, default=10,
+        help="The size limit of --response-cache-dir. Expired files and the "
+             "least recently used ones beyond it are removed.")
     args = parser.parse_args()
     logger.info(f"args: {args}")
 
@@ -200,5 +509,23 @@ if __name__ == "__main__":
                          args.device,
                          args.num_gpus,
                          args.max_gpu_memory,
-                         args.load_8bit)
+                         args.load_8bit,
+                         args.continuous_batching,
+                         args.max_batch_size,
+                         args.conv_kv_cache_gb,
+                         args.system_prompt_cache,
+                         args.draft_model_path,
+                         args.num_speculative_tokens,
+                         get_compression_config(args),
+                         args.quantize_kv_cache,
+                         args.paged_kv_cache_gb,
+                         args.kv_block_size,
+                         args.limit_model_concurrency,
+                         args.kv_cache_budget_gb,
+                         args.prefill_chunk_size,
+                         args.attention_sinks,
+                         args.response_cache_gb,
+                         args.response_cache_ttl,
+                         args.response_cache_dir,
+                         args.response_cache_disk_gb)
     uvicorn.run(app, host=args.host, port=args.port, log_level="info")
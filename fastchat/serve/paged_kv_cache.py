@@ -0,0 +1,230 @@
+"""
+A paged KV cache for LLaMA models.
+
+Instead of one contiguous buffer per request, the keys and values of all
+requests live in a pool of fixed-size blocks that is allocated once. Every
+request has a block table mapping its positions to blocks, so memory is
+only taken one block at a time as the sequence grows and is returned to the
+pool when the request finishes.
+
+Full blocks are indexed by a hash of all tokens up to the end of the block.
+A new request whose prompt starts with the same tokens reuses these blocks
+instead of prefilling them, e.g. the system prompt of a template or the
+previous turns of a conversation. A block is shared by reference counting;
+only full blocks are shared, so a shared block is never written. Blocks
+that are no longer used keep their contents and are evicted in LRU order
+when the pool runs out of free blocks.
+"""
+import collections
+import threading
+from typing import List
+
+import torch
+
+from fastchat.serve.kv_cache import StaticKVLayer
+
+
+class OutOfKVBlocksError(RuntimeError):
+    pass
+
+
+class KVBlockPool:
+    """Preallocated key and value blocks of all layers of a model."""
+
+    def __init__(self, model, num_blocks: int, block_size: int = 16):
+        config = model.config
+        num_heads = config.num_attention_heads
+        head_dim = config.hidden_size // num_heads
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+
+        # [num_blocks * block_size, heads, head_dim] per layer. Slot
+        # `block * block_size + offset` holds one position of one block.
+        self.keys, self.values = [], []
+        for decoder_layer in model.model.layers:
+            # The weights of the linear layers may be compressed, so take the
+            # device and dtype from the layer norm.
+            weight = decoder_layer.input_layernorm.weight
+            shape = (num_blocks * block_size, num_heads, head_dim)
+            self.keys.append(torch.empty(shape, dtype=weight.dtype, device=weight.device))
+            self.values.append(torch.empty(shape, dtype=weight.dtype, device=weight.device))
+
+        self.ref_counts = [0] * num_blocks
+        self.free_blocks = list(range(num_blocks - 1, -1, -1))
+        # Unused blocks that still hold a cached prefix, in LRU order.
+        self.evictable_blocks = collections.OrderedDict()
+        self.cached_blocks = {}  # prefix hash -> block
+        self.block_hashes = {}  # block -> prefix hash
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_memory(cls, model, max_bytes: int, block_size: int = 16):
+        """Allocate as many blocks as fit in `max_bytes`."""
+        weight = model.model.layers[0].input_layernorm.weight
+        bytes_per_block = (2 * len(model.model.layers) * block_size *
+                           model.config.hidden_size * weight.element_size())
+        return cls(model, max(max_bytes // bytes_per_block, 1), block_size)
+
+    def num_free_blocks(self):
+        """The number of blocks that can be allocated, including evictable ones."""
+        return len(self.free_blocks) + len(self.evictable_blocks)
+
+    def num_blocks_needed(self, num_tokens: int):
+        return (num_tokens + self.block_size - 1) // self.block_size
+
+    def allocate(self):
+        with self.lock:
+            if self.free_blocks:
+                block = self.free_blocks.pop()
+            elif self.evictable_blocks:
+                block, _ = self.evictable_blocks.popitem(last=False)
+                del self.cached_blocks[self.block_hashes.pop(block)]
+            else:
+                raise OutOfKVBlocksError(
+                    f"All {self.num_blocks} blocks of the KV cache are in use.")
+            self.ref_counts[block] = 1
+            return block
+
+    def acquire_cached(self, prefix_hash):
+        """Share the block cached for `prefix_hash`, or return None."""
+        with self.lock:
+            block = self.cached_blocks.get(prefix_hash, None)
+            if block is not None:
+                if self.ref_counts[block] == 0:
+                    del self.evictable_blocks[block]
+                self.ref_counts[block] += 1
+            return block
+
+    def register(self, block, prefix_hash):
+        """Make a full block reusable by later requests with the same prefix."""
+        with self.lock:
+            if prefix_hash not in self.cached_blocks and block not in self.block_hashes:
+                self.cached_blocks[prefix_hash] = block
+                self.block_hashes[block] = prefix_hash
+
+    def release(self, blocks: List[int]):
+        with self.lock:
+            for block in blocks:
+                self.ref_counts[block] -= 1
+                if self.ref_counts[block] == 0:
+                    if block in self.block_hashes:
+                        self.evictable_blocks[block] = None
+                    else:
+                        self.free_blocks.append(block)
+
+
+class PagedKVLayer(StaticKVLayer):
+    """The keys and values of one sequence in one layer of a KVBlockPool.
+
+    Indexing gathers the filled positions of the sequence from its blocks
+    into a [1, heads, length, head_dim] tensor.
+    """
+
+    def __init__(self, cache, key, value):
+        super().__init__(key, value)
+        self.cache = cache
+
+    def __getitem__(self, i):
+        slots = self.cache.slots[:self.length].to(self.key.device)
+        return (self.key, self.value)[i][slots].transpose(0, 1).unsqueeze(0)
+
+    def update(self, key_states, value_states):
+        start, end = self.length, self.length + key_states.shape[2]
+        if end > len(self.cache.slots):
+            raise ValueError("The blocks of new tokens must be allocated with "
+                             "PagedKVCache.append before the forward pass.")
+        slots = self.cache.slots[start:end].to(self.key.device)
+        # [1, heads, n, head_dim] -> [n, heads, head_dim]
+        self.key.index_copy_(0, slots, key_states[0].transpose(0, 1))
+        self.value.index_copy_(0, slots, value_states[0].transpose(0, 1))
+        self.length = end
+        return self[0], self[1]
+
+
+class PagedKVCache:
+    """The block table of one sequence, usable as its past key values.
+
+    Call `append` with the token ids of every forward pass before running it,
+    `commit` after it to share the new full blocks, and `free` at the end.
+    """
+
+    def __init__(self, pool: KVBlockPool):
+        self.pool = pool
+        self.block_table = []
+        self.token_ids = []
+        self.slots = torch.empty(0, dtype=torch.long)
+        self.prefix_hashes = []
+        self.layers = [PagedKVLayer(self, key, value)
+                       for key, value in zip(pool.keys, pool.values)]
+
+    def __getitem__(self, i):
+        return self.layers[i]
+
+    def __len__(self):
+        return len(self.layers)
+
+    def __iter__(self):
+        return iter(self.layers)
+
+    def _block_hash(self, i):
+        block_size = self.pool.block_size
+        prev = self.prefix_hashes[i - 1] if i > 0 else None
+        return hash((prev, tuple(self.token_ids[i * block_size:(i + 1) * block_size])))
+
+    def _add_slots(self, start, end):
+        block_size = self.pool.block_size
+        slots = [self.block_table[pos // block_size] * block_size + pos % block_size
+                 for pos in range(start, end)]
+        self.slots = torch.cat([self.slots, torch.tensor(slots, dtype=torch.long)])
+
+    def match_prefix(self, input_ids: List[int]) -> int:
+        """Share the cached blocks of the longest prefix of a new sequence.
+
+        Return the number of reused tokens. At least one token is left to
+        compute the next-token logits.
+        """
+        assert not self.token_ids
+        block_size = self.pool.block_size
+        for start in range(0, len(input_ids) - block_size, block_size):
+            self.token_ids.extend(input_ids[start:start + block_size])
+            prefix_hash = self._block_hash(len(self.block_table))
+            block = self.pool.acquire_cached(prefix_hash)
+            if block is None:
+                del self.token_ids[start:]
+                break
+            self.block_table.append(block)
+            self.prefix_hashes.append(prefix_hash)
+
+        self._add_slots(0, len(self.token_ids))
+        for layer in self.layers:
+            layer.length = len(self.token_ids)
+        return len(self.token_ids)
+
+    def append(self, token_ids: List[int]):
+        """Allocate the blocks of the tokens of the next forward pass."""
+        start = len(self.token_ids)
+        self.token_ids.extend(token_ids)
+        num_blocks = self.pool.num_blocks_needed(len(self.token_ids))
+        try:
+            while len(self.block_table) < num_blocks:
+                self.block_table.append(self.pool.allocate())
+        except OutOfKVBlocksError:
+            del self.token_ids[start:]
+            raise
+        self._add_slots(start, len(self.token_ids))
+
+    def commit(self):
+        """Share the blocks that have been filled by the last forward pass."""
+        num_full = len(self.token_ids) // self.pool.block_size
+        for i in range(len(self.prefix_hashes), num_full):
+            self.prefix_hashes.append(self._block_hash(i))
+            self.pool.register(self.block_table[i], self.prefix_hashes[i])
+
+    def free(self):
+        self.pool.release(self.block_table)
+        self.block_table = []
+        self.token_ids = []
+        self.slots = self.slots[:0]
+        self.prefix_hashes = []
+        for layer in self.layers:
+            layer.length = 0
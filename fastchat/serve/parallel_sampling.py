@@ -0,0 +1,140 @@
+"""
+Parallel sampling (`n`) and best-of sampling (`best_of`) with one prefill.
+
+The prompt is prefilled once and its KV cache is copied to `best_of` rows
+that are decoded as one batch. All rows have the same length, so no
+attention mask is needed, and a row leaves the batch when it finishes.
+
+With `best_of == n`, the outputs of all sequences are streamed interleaved
+and carry the `index` of their sequence. With `best_of > n`, only the `n`
+sequences with the highest log probability per token are returned at the
+end, as in the OpenAI API.
+"""
+from typing import List
+
+import torch
+
+from fastchat.serve.detokenizer import IncrementalDetokenizer
+from fastchat.serve.sampling import LogitsProcessor, SamplingParams
+from fastchat.serve.stop_matcher import StopMatcher
+
+
+def get_num_samples(params):
+    """Return (n, best_of) of a request, or raise ValueError."""
+    n = int(params.get("n", 1))
+    best_of = int(params.get("best_of", None) or n)
+    if n < 1:
+        raise ValueError(f"n must be at least 1, got {n}.")
+    if best_of < n:
+        raise ValueError(f"best_of must be at least n, got best_of={best_of} and n={n}.")
+    return n, best_of
+
+
+def select_best(outputs: List[dict], logprobs: List[float], n: int):
+    """Return the final outputs of the n sequences with the best mean log probability."""
+    def score(i):
+        return logprobs[i] / max(outputs[i]["usage"]["completion_tokens"], 1)
+    best = sorted(range(len(outputs)), key=score, reverse=True)[:n]
+    return [dict(outputs[i], index=j) for j, i in enumerate(best)]
+
+
+def expand_kv(past_key_values, num_rows):
+    return tuple(tuple(x.repeat(num_rows, *[1] * (x.dim() - 1)) for x in layer)
+                 for layer in past_key_values)
+
+
+@torch.inference_mode()
+def parallel_generate_stream(model, tokenizer, params, device,
+                             context_len=2048, stream_interval=2,
+                             prefill_chunk_size=None, input_ids=None):
+    prompt = params["prompt"]
+    n, best_of = get_num_samples(params)
+    sampling_params = SamplingParams.from_dict(params)
+    max_new_tokens = int(params.get("max_new_tokens", 256))
+    echo = params.get("echo", True)
+    streaming = best_of == n
+
+    if input_ids is None:
+        input_ids = tokenizer(prompt).input_ids
+    max_src_len = context_len - max_new_tokens - 8
+    input_ids = input_ids[-max_src_len:]
+
+    # Prefill the prompt once.
+    past_key_values = None
+    chunk_size = prefill_chunk_size or len(input_ids)
+    for start in range(0, len(input_ids), chunk_size):
+        out = model(torch.as_tensor([input_ids[start:start + chunk_size]], device=device),
+                    use_cache=True, past_key_values=past_key_values)
+        past_key_values = out.past_key_values
+    logits = out.logits[:, -1].repeat(best_of, 1)
+    past_key_values = expand_kv(past_key_values, best_of)
+
+    detokenizers = [IncrementalDetokenizer(tokenizer, input_ids) for _ in range(best_of)]
+    stop_matchers = [StopMatcher.from_params(params, tokenizer) for _ in range(best_of)]
+    logprobs = [0.0] * best_of
+    num_yielded = [0] * best_of
+    final_outputs = [None] * best_of
+    # The sequences of the rows of the batch.
+    active = list(range(best_of))
+
+    for step in range(max_new_tokens):
+        if device == "mps":
+            # Switch to CPU by avoiding some bugs in mps backend.
+            logits = logits.float().to("cpu")
+        if not streaming:
+            row_logprobs = torch.log_softmax(logits.float(), dim=-1)
+        logits_processor = LogitsProcessor([sampling_params] * len(active))
+        tokens = logits_processor.sample(logits, [input_ids] * len(active),
+            [detokenizers[i].output_ids for i in active])
+
+        keep = []
+        for row, (i, token) in enumerate(zip(active, tokens)):
+            detokenizer = detokenizers[i]
+            stop_pos = stop_matchers[i].update(token, detokenizer.add_tokens([token]))
+            if not streaming:
+                logprobs[i] += row_logprobs[row, token].item()
+
+            if stop_pos is not None:
+                finish_reason = "stop"
+            elif step == max_new_tokens - 1:
+                finish_reason = "length"
+            else:
+                finish_reason = None
+                keep.append(row)
+
+            if finish_reason is not None or (streaming and step % stream_interval == 0):
+                output = detokenizer.output[:stop_pos]
+                ret = {
+                    "index": i,
+                    "text": detokenizer.prompt_text + output if echo else output,
+                    "token_ids": detokenizer.output_ids[num_yielded[i]:],
+                    "usage": {
+                        "prompt_tokens": len(input_ids),
+                        "completion_tokens": step + 1,
+                        "total_tokens": len(input_ids) + step + 1,
+                    },
+                    "finish_reason": finish_reason,
+                }
+                num_yielded[i] = step + 1
+                if streaming:
+                    yield ret
+                else:
+                    ret["token_ids"] = detokenizer.output_ids
+                    final_outputs[i] = ret
+
+        if not keep:
+            break
+        if len(keep) < len(active):
+            index = torch.as_tensor(keep, device=past_key_values[0][0].device)
+            past_key_values = tuple(tuple(x.index_select(0, index) for x in layer)
+                                    for layer in past_key_values)
+            active = [active[row] for row in keep]
+            tokens = [tokens[row] for row in keep]
+        out = model(torch.as_tensor(tokens, device=device).unsqueeze(1),
+                    use_cache=True, past_key_values=past_key_values)
+        logits = out.logits[:, -1]
+        past_key_values = out.past_key_values
+
+    del past_key_values
+    if not streaming:
+        yield from select_best(final_outputs, logprobs, n)
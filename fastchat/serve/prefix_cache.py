@@ -0,0 +1,167 @@
+"""
+Reuse the KV cache of a prompt prefix across requests.
+
+Turn N+1 of a conversation is turn N's prompt plus its answer and a new
+question. Keeping the past key values of turn N lets the next turn prefill
+only the new suffix instead of the whole conversation. In the same way,
+every prompt of a conversation template starts with the template's system
+message, whose past key values can be computed once and shared.
+"""
+import collections
+import dataclasses
+import threading
+from typing import List, Optional, Tuple
+
+import torch
+
+
+def common_prefix_len(a: List[int], b: List[int]):
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
+
+def kv_nbytes(past_key_values):
+    return sum(x.numel() * x.element_size() for layer in past_key_values for x in layer)
+
+
+def truncate_kv(past_key_values, length):
+    """Keep the first `length` positions of a [batch, heads, seq_len, head_dim] cache."""
+    return tuple(tuple(x[:, :, :length] for x in layer) for layer in past_key_values)
+
+
+@dataclasses.dataclass
+class KVCacheEntry:
+    token_ids: List[int]
+    prefix_hash: int
+    past_key_values: tuple
+    nbytes: int
+    # The positions token_ids[num_sinks:num_sinks + num_evicted] are not in
+    # past_key_values, see evict_kv.
+    num_sinks: int = 0
+    num_evicted: int = 0
+
+
+class ConversationKVCache:
+    """An LRU cache of past key values keyed by conversation id.
+
+    An entry is reused for a new prompt when its tokens are a prefix of the
+    prompt, which is checked with a hash of the prompt prefix. Otherwise,
+    e.g. when the last answer was cut at a stop string or re-tokenized
+    differently, the longest common token prefix is reused.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.num_hits = 0
+        self.num_misses = 0
+
+    def get(self, conv_id, input_ids: List[int]) -> Tuple[int, Optional[tuple]]:
+        """Return the number of reusable prompt tokens and their past key values."""
+        with self.lock:
+            entry = self.entries.get(conv_id, None) if conv_id else None
+            if entry is not None:
+                self.entries.move_to_end(conv_id)
+        if entry is None:
+            self.num_misses += 1
+            return 0, None
+
+        n = len(entry.token_ids)
+        if n > len(input_ids) or hash(tuple(input_ids[:n])) != entry.prefix_hash:
+            n = common_prefix_len(entry.token_ids, input_ids)
+        # At least one prompt token is needed to compute the next-token logits.
+        n = min(n, len(input_ids) - 1)
+        if n < entry.num_sinks + entry.num_evicted:
+            # Only the sinks are cached before the evicted positions.
+            n = min(n, entry.num_sinks)
+        if n <= 0:
+            self.num_misses += 1
+            return 0, None
+
+        self.num_hits += 1
+        kv_len = n if n <= entry.num_sinks else n - entry.num_evicted
+        return n, truncate_kv(entry.past_key_values, kv_len)
+
+    def put(self, conv_id, token_ids: List[int], past_key_values,
+            num_sinks: int = 0, num_evicted: int = 0):
+        """Store the past key values that cover `token_ids`, except for
+        `num_evicted` evicted positions after the first `num_sinks` ones."""
+        if not conv_id:
+            return
+        entry = KVCacheEntry(list(token_ids), hash(tuple(token_ids)),
+                             past_key_values, kv_nbytes(past_key_values),
+                             num_sinks, num_evicted)
+
+        with self.lock:
+            self.pop(conv_id)
+            if entry.nbytes > self.max_bytes:
+                return
+            while self.total_bytes + entry.nbytes > self.max_bytes:
+                self.pop(next(iter(self.entries)))
+            self.entries[conv_id] = entry
+            self.total_bytes += entry.nbytes
+
+    def pop(self, conv_id):
+        entry = self.entries.pop(conv_id, None)
+        if entry is not None:
+            self.total_bytes -= entry.nbytes
+
+
+class SystemPromptCache:
+    """Pinned KV caches of the fixed prefix of every conversation template.
+
+    Every prompt built from a template starts with the same system message
+    (and, for conv_one_shot, the same example conversation). Its KV cache is
+    computed once at startup and every matching request starts its prefill
+    from it. The boundary token of the prefix may be tokenized differently
+    inside a full prompt, so the longest common token prefix is used.
+    """
+
+    def __init__(self):
+        # List[(token_ids, past_key_values)]
+        self.entries = []
+
+    @torch.inference_mode()
+    def add_prefix(self, model, tokenizer, device, prefix: str):
+        token_ids = tokenizer(prefix).input_ids
+        if len(token_ids) < 2:
+            return
+        out = model(torch.as_tensor([token_ids], device=device), use_cache=True)
+        self.entries.append((token_ids, out.past_key_values))
+
+    @classmethod
+    def from_templates(cls, model, tokenizer, device, templates):
+        cache = cls()
+        for template in templates:
+            cache.add_prefix(model, tokenizer, device, template.copy().get_prompt())
+        return cache
+
+    def get(self, input_ids: List[int]) -> Tuple[int, Optional[tuple]]:
+        """Return the number of reusable prompt tokens and their past key values."""
+        best_n, best_past = 0, None
+        for token_ids, past_key_values in self.entries:
+            n = min(common_prefix_len(token_ids, input_ids), len(input_ids) - 1)
+            if n > best_n:
+                best_n, best_past = n, past_key_values
+        if best_n == 0:
+            return 0, None
+        return best_n, truncate_kv(best_past, best_n)
+
+
+def lookup_prefix(input_ids: List[int], session_id=None,
+                  conv_kv_cache: ConversationKVCache = None,
+                  system_prompt_cache: SystemPromptCache = None):
+    """Return the longest cached prefix of a prompt and its past key values."""
+    num_cached, past_key_values = 0, None
+    if conv_kv_cache is not None:
+        num_cached, past_key_values = conv_kv_cache.get(session_id, input_ids)
+    if system_prompt_cache is not None:
+        n, past = system_prompt_cache.get(input_ids)
+        if n > num_cached:
+            num_cached, past_key_values = n, past
+    return num_cached, past_key_values
@@ -0,0 +1,256 @@
+"""
+An exact-match cache of the responses of deterministic requests.
+
+Requests with greedy sampling always produce the same stream, so their
+encoded frames are cached under a hash of the model name, the prompt
+token ids and the parameters that change the output. A cached stream is
+replayed frame by frame. Entries expire after a TTL, and the memory tier
+evicts in LRU order beyond a size limit. An optional directory keeps the
+entries across restarts, within its own size limit. The files are read and
+written on the default executor, off the event loop.
+
+Concurrent identical requests are coalesced: the first one generates the
+stream in a background task and all of them read its frames as they are
+produced.
+"""
+import asyncio
+import collections
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import List, Optional
+
+from fastchat.serve.sampling import SamplingParams
+
+
+# The request parameters besides the prompt that change the stream of a
+# greedy request.
+CACHE_KEY_PARAMS = ("max_new_tokens", "stop", "stop_token_ids", "echo",
+                    "stream_protocol", "n", "best_of", "repetition_penalty",
+                    "presence_penalty", "frequency_penalty")
+
+
+def response_cache_key(model_name: str, token_ids: List[int], params) -> Optional[str]:
+    """The cache key of a request, or None if its response is not deterministic."""
+    if not SamplingParams.from_dict(params).greedy:
+        return None
+    fields = {name: params.get(name, None) for name in CACHE_KEY_PARAMS}
+    data = json.dumps([model_name, token_ids, fields], sort_keys=True)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+class InFlightResponse:
+    """The frames of a stream that is being generated, readable by many clients.
+
+    All methods must be called from the event loop.
+    """
+
+    def __init__(self):
+        self.frames: List[bytes] = []
+        self.done = False
+        # Replaced by a new event whenever a frame is appended.
+        self.changed = asyncio.Event()
+
+    def append(self, frame: bytes):
+        self.frames.append(frame)
+        self._notify()
+
+    def finish(self):
+        self.done = True
+        self._notify()
+
+    def _notify(self):
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+    async def replay(self):
+        """Yield all frames, waiting for the ones that are not generated yet."""
+        i = 0
+        while True:
+            if i < len(self.frames):
+                i += 1
+                yield self.frames[i - 1]
+            elif self.done:
+                return
+            else:
+                await self.changed.wait()
+
+
+class ResponseCache:
+    """An LRU cache of encoded response frames with a TTL and a disk tier."""
+
+    # Expired files are swept at most this often, in seconds.
+    sweep_interval = 60
+
+    def __init__(self, max_bytes: int, ttl: float = 3600, disk_dir: Optional[str] = None,
+                 max_disk_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+
+        self.entries = collections.OrderedDict()  # key -> (expire_time, frames)
+        self.nbytes = 0
+        # The files of the disk tier in LRU order: key -> (mtime, nbytes).
+        self.disk_entries = collections.OrderedDict()
+        self.disk_nbytes = 0
+        self.last_sweep_time = time.time()
+        self.in_flight = {}  # key -> InFlightResponse
+        self.lock = threading.Lock()
+        self.num_hits = 0
+        self.num_coalesced = 0
+        self.num_misses = 0
+
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+            self._load_disk()
+
+    async def get(self, key: str) -> Optional[List[bytes]]:
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is not None:
+                if entry[0] > time.time():
+                    self.entries.move_to_end(key)
+                    self.num_hits += 1
+                    return entry[1]
+                self._remove(key)
+            if key not in self.disk_entries:
+                return None
+
+        frames, mtime = await asyncio.get_running_loop().run_in_executor(
+            None, self._read_disk, key)
+        if frames is not None:
+            with self.lock:
+                self.num_hits += 1
+            self._put_memory(key, frames, mtime + self.ttl)
+        return frames
+
+    def start(self, key: str):
+        """Return (the in-flight response of key, whether the caller must generate it)."""
+        with self.lock:
+            response = self.in_flight.get(key, None)
+            if response is not None:
+                self.num_coalesced += 1
+                return response, False
+            response = self.in_flight[key] = InFlightResponse()
+            self.num_misses += 1
+            return response, True
+
+    async def finish(self, key: str, response: InFlightResponse, success: bool):
+        """End the replays of a generated response, and cache it if it succeeded."""
+        # Put it in memory before it stops being in flight, so that identical
+        # requests always find it.
+        if success:
+            self._put_memory(key, response.frames, time.time() + self.ttl)
+        with self.lock:
+            del self.in_flight[key]
+        response.finish()
+        if success and self.disk_dir is not None:
+            await asyncio.get_running_loop().run_in_executor(
+                None, self._write_disk, key, response.frames)
+
+    def _put_memory(self, key, frames, expire_time):
+        nbytes = sum(len(frame) for frame in frames)
+        if nbytes > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (expire_time, frames)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+
+    def _remove(self, key):
+        _, frames = self.entries.pop(key)
+        self.nbytes -= sum(len(frame) for frame in frames)
+
+    def _path(self, key):
+        return os.path.join(self.disk_dir, key)
+
+    def _load_disk(self):
+        """Index the files of an earlier run, oldest first, and remove the
+        expired ones and the partial writes."""
+        files = []
+        for name in os.listdir(self.disk_dir):
+            path = os.path.join(self.disk_dir, name)
+            try:
+                if name.endswith(".tmp"):
+                    os.remove(path)
+                    continue
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, name, stat.st_size))
+        with self.lock:
+            for mtime, key, nbytes in sorted(files):
+                self.disk_entries[key] = (mtime, nbytes)
+                self.disk_nbytes += nbytes
+        self._sweep_disk(force=True)
+
+    def _read_disk(self, key):
+        """Return the frames and the mtime of a file, or (None, None)."""
+        with self.lock:
+            entry = self.disk_entries.get(key, None)
+            if entry is None:
+                return None, None
+            if entry[0] + self.ttl <= time.time():
+                self._remove_disk(key)
+                return None, None
+            self.disk_entries.move_to_end(key)
+        try:
+            with open(self._path(key), "rb") as fin:
+                data = fin.read()
+        except FileNotFoundError:
+            with self.lock:
+                if self.disk_entries.get(key, None) == entry:
+                    self._remove_disk(key)
+            return None, None
+        # Every frame ends with b"\0".
+        return [frame + b"\0" for frame in data.split(b"\0")[:-1]], entry[0]
+
+    def _write_disk(self, key, frames):
+        data = b"".join(frames)
+        if len(data) > self.max_disk_bytes:
+            return
+        # Write to a temporary file first, so readers never see a partial entry.
+        tmp_path = f"{self._path(key)}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as fout:
+            fout.write(data)
+        os.replace(tmp_path, self._path(key))
+        with self.lock:
+            if key in self.disk_entries:
+                self.disk_nbytes -= self.disk_entries.pop(key)[1]
+            self.disk_entries[key] = (time.time(), len(data))
+            self.disk_nbytes += len(data)
+        self._sweep_disk()
+
+    def _sweep_disk(self, force=False):
+        """Remove the expired files, and the least recently used ones beyond
+        the size limit."""
+        with self.lock:
+            now = time.time()
+            if force or now - self.last_sweep_time >= self.sweep_interval:
+                self.last_sweep_time = now
+                for key, (mtime, _) in list(self.disk_entries.items()):
+                    if mtime + self.ttl <= now:
+                        self._remove_disk(key)
+            while self.disk_nbytes > self.max_disk_bytes:
+                self._remove_disk(next(iter(self.disk_entries)))
+
+    def _remove_disk(self, key):
+        """Remove the file of a key. The caller holds the lock."""
+        _, nbytes = self.disk_entries.pop(key)
+        self.disk_nbytes -= nbytes
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def __repr__(self):
+        return (f"ResponseCache(entries={len(self.entries)}, nbytes={self.nbytes}, "
+                f"disk_entries={len(self.disk_entries)}, disk_nbytes={self.disk_nbytes}, "
+                f"hits={self.num_hits}, coalesced={self.num_coalesced}, "
+                f"misses={self.num_misses})")
@@ -0,0 +1,208 @@
+"""
+Logits processing and sampling shared by all generate functions.
+
+A LogitsProcessor applies the SamplingParams of every row of a
+[batch, vocab] logits tensor in one pass: repetition, presence and frequency
+penalties, temperature, top-k and top-p. Each stage only runs if some row
+uses it, and rows that decode greedily take the argmax without a softmax.
+"""
+import dataclasses
+from typing import List, Optional
+
+import torch
+
+
+@dataclasses.dataclass
+class SamplingParams:
+    temperature: float = 1.0
+    top_p: float = 1.0
+    # 0 or -1 disables top-k.
+    top_k: int = -1
+    # Divide the positive logits and multiply the negative logits of tokens
+    # in the prompt or the output by this (CTRL).
+    repetition_penalty: float = 1.0
+    # Subtract this once from the logits of tokens in the output.
+    presence_penalty: float = 0.0
+    # Subtract this times the count of each token in the output.
+    frequency_penalty: float = 0.0
+
+    @classmethod
+    def from_dict(cls, params: dict):
+        return cls(
+            temperature=float(params.get("temperature", 1.0)),
+            top_p=float(params.get("top_p", 1.0)),
+            top_k=int(params.get("top_k", -1)),
+            repetition_penalty=float(params.get("repetition_penalty", 1.0)),
+            presence_penalty=float(params.get("presence_penalty", 0.0)),
+            frequency_penalty=float(params.get("frequency_penalty", 0.0)),
+        )
+
+    @property
+    def greedy(self):
+        return self.temperature < 1e-4
+
+
+def pad_token_ids(token_ids: List[List[int]], device):
+    """Return a [batch, max_len] tensor of token ids and a mask of the real ones.
+
+    A row is padded with its first token, so that scattering the value of
+    its first token to the padding writes the same value to the same
+    position again. Empty rows are padded with token 0.
+    """
+    max_len = max(max(len(ids) for ids in token_ids), 1)
+    padded = torch.tensor([ids + [ids[0] if ids else 0] * (max_len - len(ids))
+                           for ids in token_ids], dtype=torch.long, device=device)
+    lengths = torch.tensor([len(ids) for ids in token_ids], device=device)
+    mask = torch.arange(max_len, device=device).unsqueeze(0) < lengths.unsqueeze(1)
+    return padded, mask
+
+
+class LogitsProcessor:
+    """Apply a SamplingParams per row to [batch, vocab] logits."""
+
+    # Top-p first looks for its tokens among this many most likely ones and
+    # only sorts the whole vocabulary of the rows where they are not enough.
+    num_top_p_candidates = 256
+
+    def __init__(self, params: List[SamplingParams]):
+        self.params = params
+        self.greedy = [p.greedy for p in params]
+        self.use_repetition = any(p.repetition_penalty != 1.0 for p in params)
+        self.use_frequency = any(p.frequency_penalty != 0.0 for p in params)
+        self.use_presence = any(p.presence_penalty != 0.0 for p in params)
+        self.use_top_p = any(p.top_p < 1.0 and not p.greedy for p in params)
+
+    def column(self, name, device, default=None):
+        """The value of a sampling parameter for every row, as a [batch, 1] tensor."""
+        values = [getattr(p, name) for p in self.params]
+        if default is not None:
+            values = [default if g else v for g, v in zip(self.greedy, values)]
+        return torch.tensor(values, dtype=torch.float32, device=device).unsqueeze(1)
+
+    def __call__(self, logits, prompt_ids: Optional[List[List[int]]] = None,
+                 output_ids: Optional[List[List[int]]] = None):
+        """Process float logits in place and return them.
+
+        The penalties need the token ids of the prompt and the output of
+        every row. Greedy rows only get the penalties.
+        """
+        device = logits.device
+        vocab_size = logits.shape[-1]
+
+        # The penalties only touch the logits of the tokens that occurred.
+        if self.use_repetition:
+            ids, mask = pad_token_ids([a + b for a, b in zip(prompt_ids, output_ids)], device)
+            selected = logits.gather(1, ids)
+            penalty = self.column("repetition_penalty", device)
+            penalized = torch.where(selected > 0, selected / penalty, selected * penalty)
+            # The padding of a row is one of its tokens and is penalized too,
+            # except in empty rows, where it is not a token of the row.
+            nonempty = mask[:, :1]
+            logits.scatter_(1, ids, torch.where(nonempty, penalized, selected))
+        if self.use_frequency or self.use_presence:
+            ids, mask = pad_token_ids(output_ids, device)
+            mask = mask.float()
+            if self.use_frequency:
+                logits.scatter_add_(1, ids, mask * -self.column("frequency_penalty", device))
+            if self.use_presence:
+                present = torch.zeros_like(logits).scatter_add_(1, ids, mask) > 0
+                logits.sub_(present * self.column("presence_penalty", device))
+
+        if all(self.greedy):
+            return logits
+
+        logits.div_(self.column("temperature", device, default=1.0))
+        # A top-k of 0, -1 or at least the vocabulary size keeps all tokens.
+        top_k = [p.top_k if 0 < p.top_k < vocab_size and not p.greedy else vocab_size
+                 for p in self.params]
+        use_top_k = any(k < vocab_size for k in top_k)
+        if not use_top_k and not self.use_top_p:
+            return logits
+
+        # The most likely tokens of every row in descending order.
+        num_candidates = max((k for k in top_k if k < vocab_size), default=0)
+        if self.use_top_p:
+            num_candidates = max(num_candidates, self.num_top_p_candidates)
+        num_candidates = min(num_candidates, vocab_size)
+        values = torch.topk(logits, num_candidates, dim=-1).values
+
+        if use_top_k:
+            index = torch.tensor(top_k, device=device).clamp_(max=num_candidates) - 1
+            kth = values.gather(1, index.unsqueeze(1))
+            kth.masked_fill_(torch.tensor(top_k, device=device).unsqueeze(1) >= vocab_size,
+                             -float("inf"))
+            logits.masked_fill_(logits < kth, -float("inf"))
+            values.masked_fill_(values < kth, -float("inf"))
+
+        if self.use_top_p:
+            top_p = self.column("top_p", device, default=1.0)
+            # The rounding errors of cumsum must not remove tokens of rows
+            # without top-p.
+            top_p.masked_fill_(top_p >= 1.0, float("inf"))
+            probs = torch.exp(values - torch.logsumexp(logits, dim=-1, keepdim=True))
+            # Keep the smallest set of tokens whose probability reaches top_p.
+            remove = probs.cumsum(dim=-1) - probs > top_p
+            num_keep = (~remove).sum(dim=-1, keepdim=True)
+            threshold = values.gather(1, num_keep - 1)
+            threshold.masked_fill_(~remove[:, -1:], -float("inf"))
+            logits.masked_fill_(logits < threshold, -float("inf"))
+
+            # Rows whose kept tokens may not all be among the candidates.
+            missing = ~remove[:, -1] & top_p.squeeze(1).isfinite()
+            if num_candidates < vocab_size and missing.any():
+                rows = missing.nonzero().squeeze(1)
+                sorted_logits, indices = torch.sort(logits.index_select(0, rows), dim=-1)
+                cum_probs = torch.softmax(sorted_logits, dim=-1).cumsum(dim=-1)
+                remove = cum_probs <= 1 - top_p.index_select(0, rows)
+                remove[:, -1] = False
+                sorted_logits.masked_fill_(remove, -float("inf"))
+                logits.index_copy_(0, rows, sorted_logits.scatter(1, indices, sorted_logits))
+        return logits
+
+    def probs(self, logits, prompt_ids=None, output_ids=None):
+        """Return the sampling distribution of every row; one-hot for greedy rows."""
+        logits = self(logits.float(), prompt_ids, output_ids)
+        probs = torch.softmax(logits, dim=-1)
+        if any(self.greedy):
+            rows = torch.tensor(self.greedy, device=logits.device)
+            one_hot = torch.nn.functional.one_hot(
+                torch.argmax(logits, dim=-1), logits.shape[-1]).to(probs.dtype)
+            probs = torch.where(rows.unsqueeze(1), one_hot, probs)
+        return probs
+
+    def sample(self, logits, prompt_ids=None, output_ids=None) -> List[int]:
+        """Return one token per row."""
+        logits = self(logits.float(), prompt_ids, output_ids)
+        tokens = torch.argmax(logits, dim=-1)
+        if not all(self.greedy):
+            rows = torch.tensor([not g for g in self.greedy]).nonzero().squeeze(1)
+            rows = rows.to(logits.device)
+            # Inverse transform sampling, which is much faster than
+            # torch.multinomial for a large vocabulary on CPU.
+            cdf = torch.softmax(logits.index_select(0, rows), dim=-1).cumsum_(dim=-1)
+            u = torch.rand((len(rows), 1), device=logits.device) * cdf[:, -1:]
+            sampled = torch.searchsorted(cdf, u, right=True).squeeze(1)
+            tokens[rows] = sampled.clamp_(max=logits.shape[-1] - 1)
+        return tokens.tolist()
+
+
+class HFLogitsProcessor:
+    """Run a LogitsProcessor inside huggingface `generate`.
+
+    Pass `temperature=1.0, top_p=1.0` to `generate`, so that its own
+    warpers do not apply them a second time.
+    """
+
+    def __init__(self, params: SamplingParams):
+        self.params = params
+        self.num_prompt_tokens = None
+
+    def __call__(self, input_ids, scores):
+        if self.num_prompt_tokens is None:
+            self.num_prompt_tokens = input_ids.shape[1]
+        ids = input_ids.tolist()
+        logits_processor = LogitsProcessor([self.params] * len(ids))
+        return logits_processor(
+            scores.float(),
+            [x[:self.num_prompt_tokens] for x in ids],
+            [x[self.num_prompt_tokens:] for x in ids]).to(scores.dtype)
@@ -1,6 +1,28 @@
 import torch
+from transformers import LogitsProcessorList
 from typing import List, Tuple
 
+from fastchat.serve.sampling import HFLogitsProcessor, SamplingParams
+
+
+def split_messages(messages):
+    """Return the query and the (query, response) history of a conversation."""
+    hist = []
+    for i in range(0, len(messages) - 2, 2):
+        hist.append((messages[i][1], messages[i+1][1]))
+    return messages[-2][1], hist
+
+
+def chatglm_prompt(messages):
+    """The text that `model.stream_chat` builds for a conversation."""
+    query, hist = split_messages(messages)
+    if not hist:
+        return query
+    prompt = ""
+    for i, (old_query, response) in enumerate(hist):
+        prompt += f"[Round {i}]\n问：{old_query}\n答：{response}\n"
+    return prompt + f"[Round {len(hist)}]\n问：{query}\n答："
+
 
 @torch.inference_mode()
 def chatglm_generate_stream(model, tokenizer, params, device,
@@ -8,22 +30,25 @@ def chatglm_generate_stream(model, tokenizer, params, device,
     """Generate text using model's chat api"""
     messages = params["prompt"]
     max_new_tokens = int(params.get("max_new_tokens", 256))
-    temperature = float(params.get("temperature", 1.0))
-    top_p = float(params.get("top_p", 0.7))
+    sampling_params = SamplingParams.from_dict({"top_p": 0.7, **params})
+    echo = params.get("echo", True)
 
+    # The temperature and top_p are applied by the shared logits processor.
     gen_kwargs = {
         "max_new_tokens": max_new_tokens,
-        "do_sample": True,
-        "top_p": top_p,
-        "temperature": temperature,
-        "logits_processor": None
+        "do_sample": not sampling_params.greedy,
+        "top_p": 1.0,
+        "temperature": 1.0,
+        "logits_processor": LogitsProcessorList([HFLogitsProcessor(sampling_params)]),
     }
 
-    hist = []
-    for i in range(0, len(messages) - 2, 2):
-        hist.append((messages[i][1], messages[i+1][1]))
-    query = messages[-2][1]
+    query, hist = split_messages(messages)
 
-    for response, new_hist in model.stream_chat(tokenizer, query, hist):
-        output = query + " " + response
-        yield output
+    for response, new_hist in model.stream_chat(tokenizer, query, hist, **gen_kwargs):
+        output = query + " " + response if echo else response
+        yield {
+            "text": output,
+            "token_ids": [],
+            "usage": None,
+            "finish_reason": None,
+        }
@@ -0,0 +1,169 @@
+"""
+Speculative decoding with a small draft model.
+
+The draft model proposes k tokens one by one and the target model scores
+all of them in a single forward pass. A proposed token is accepted with
+probability min(1, p(x) / q(x)), where p and q are the target and draft
+distributions. At the first rejection, a token is sampled from the residual
+distribution max(0, p - q) instead. When all k tokens are accepted, one more
+token is sampled from the target. This keeps the output distribution equal
+to that of the target model, and with greedy decoding the output is exactly
+the target's greedy output.
+"""
+import dataclasses
+import threading
+
+import torch
+
+from fastchat.serve.detokenizer import IncrementalDetokenizer
+from fastchat.serve.kv_cache import StaticKVCache, supports_static_kv_cache
+from fastchat.serve.prefix_cache import truncate_kv
+from fastchat.serve.sampling import LogitsProcessor, SamplingParams
+from fastchat.serve.stop_matcher import StopMatcher
+
+
+@dataclasses.dataclass
+class SpeculativeStats:
+    num_proposed: int = 0
+    num_accepted: int = 0
+
+    def __post_init__(self):
+        self.lock = threading.Lock()
+
+    def update(self, num_proposed, num_accepted):
+        with self.lock:
+            self.num_proposed += num_proposed
+            self.num_accepted += num_accepted
+
+    @property
+    def acceptance_rate(self):
+        return self.num_accepted / max(self.num_proposed, 1)
+
+
+class ModelState:
+    """A model and the KV cache of the tokens it has been fed."""
+
+    def __init__(self, model, device, max_len):
+        self.model = model
+        self.device = device
+        self.static_kv_cache = None
+        self.past_key_values = None
+        if supports_static_kv_cache(model):
+            self.static_kv_cache = StaticKVCache.from_model(model, max_len)
+            self.past_key_values = self.static_kv_cache
+        self.length = 0
+
+    def forward(self, token_ids):
+        """Feed new tokens and return the logits of each of them."""
+        out = self.model(torch.as_tensor([token_ids], device=self.device),
+                         use_cache=True, past_key_values=self.past_key_values)
+        if self.static_kv_cache is None:
+            self.past_key_values = out.past_key_values
+        self.length += len(token_ids)
+        return out.logits[0].float()
+
+    def truncate(self, length):
+        if length >= self.length:
+            return
+        if self.static_kv_cache is not None:
+            self.static_kv_cache.truncate(length)
+        else:
+            self.past_key_values = truncate_kv(self.past_key_values, length)
+        self.length = length
+
+
+@torch.inference_mode()
+def speculative_generate_stream(model, draft_model, tokenizer, params, device,
+                                context_len=2048, num_speculative_tokens=4,
+                                stats=None, input_ids=None):
+    if model.config.vocab_size != draft_model.config.vocab_size:
+        raise ValueError("The draft model must use the same vocabulary as the model.")
+    prompt = params["prompt"]
+    sampling_params = SamplingParams.from_dict(params)
+    max_new_tokens = int(params.get("max_new_tokens", 256))
+    stop_matcher = StopMatcher.from_params(params, tokenizer)
+    echo = params.get("echo", True)
+
+    if input_ids is None:
+        input_ids = tokenizer(prompt).input_ids
+    detokenizer = IncrementalDetokenizer(tokenizer, input_ids)
+
+    max_src_len = context_len - max_new_tokens - 8
+    input_ids = input_ids[-max_src_len:]
+    max_len = len(input_ids) + max_new_tokens + num_speculative_tokens
+    target = ModelState(model, device, max_len)
+    draft = ModelState(draft_model, device, max_len)
+
+    token_ids = list(input_ids)
+    num_generated = 0
+    stopped = False
+    while not stopped and num_generated < max_new_tokens:
+        # The last of the new tokens of a step is always sampled from the target.
+        k = min(num_speculative_tokens, max_new_tokens - num_generated - 1)
+
+        # Propose k tokens with the draft model.
+        proposals, draft_probs = [], []
+        new_ids = token_ids[draft.length:]
+        output_ids = token_ids[len(input_ids):]
+        for _ in range(k):
+            q = LogitsProcessor([sampling_params]).probs(
+                draft.forward(new_ids)[-1:], [input_ids], [output_ids + proposals])[0]
+            token = int(torch.multinomial(q, num_samples=1))
+            proposals.append(token)
+            draft_probs.append(q)
+            new_ids = [token]
+
+        # Score all proposals with the target model in one forward pass.
+        logits = target.forward(token_ids[target.length:] + proposals)
+        # Row i has the proposals before it in its output.
+        target_probs = LogitsProcessor([sampling_params] * (k + 1)).probs(
+            logits[-k - 1:], [input_ids] * (k + 1),
+            [output_ids + proposals[:i] for i in range(k + 1)])
+
+        accepted = []
+        for i, token in enumerate(proposals):
+            p, q = target_probs[i], draft_probs[i]
+            if torch.rand(1).item() < min(1.0, (p[token] / q[token]).item()):
+                accepted.append(token)
+                continue
+            residual = torch.clamp(p - q, min=0)
+            if residual.sum() <= 0:
+                residual = p
+            accepted.append(int(torch.multinomial(residual / residual.sum(), 1)))
+            break
+        else:
+            accepted.append(int(torch.multinomial(target_probs[k], 1)))
+        if stats is not None:
+            stats.update(k, len(accepted) - 1)
+
+        # Drop the cache of the rejected proposals.
+        target.truncate(len(token_ids) + len(accepted) - 1)
+        draft.truncate(len(token_ids) + len(accepted) - 1)
+
+        # Drop the accepted tokens after a stop token or string.
+        for j, token in enumerate(accepted):
+            stop_pos = stop_matcher.update(token, detokenizer.add_tokens([token]))
+            if stop_pos is not None:
+                accepted = accepted[:j + 1]
+                stopped = True
+                break
+        token_ids.extend(accepted)
+        num_generated += len(accepted)
+        output = detokenizer.output[:stop_pos]
+
+        if stopped:
+            finish_reason = "stop"
+        elif num_generated >= max_new_tokens:
+            finish_reason = "length"
+        else:
+            finish_reason = None
+        yield {
+            "text": detokenizer.prompt_text + output if echo else output,
+            "token_ids": accepted,
+            "usage": {
+                "prompt_tokens": len(input_ids),
+                "completion_tokens": num_generated,
+                "total_tokens": len(input_ids) + num_generated,
+            },
+            "finish_reason": finish_reason,
+        }
@@ -0,0 +1,92 @@
+"""
+Incremental matching of stop strings and stop token ids.
+
+`params["stop"]` may be one string or a list of strings, and
+`params["stop_token_ids"]` a list of token ids. The stop strings are
+compiled into an Aho-Corasick automaton that is fed the text of every new
+token as the detokenizer produces it, so a stop string is found on the
+step that completes it, in time proportional to the new text only, no
+matter how many stop strings there are or how long the output is.
+"""
+from typing import Iterable, List, Optional
+
+
+def get_stop_strs(params, eos_token=None) -> List[str]:
+    """The stop strings of a request as a list.
+
+    The EOS token is skipped by the detokenizer, so it never appears in the
+    text and is matched by its token id instead.
+    """
+    stop = params.get("stop", None)
+    if stop is None:
+        return []
+    if isinstance(stop, str):
+        stop = [stop]
+    return [s for s in stop if s and s != eos_token]
+
+
+class StopMatcher:
+    """Find the first stop string or stop token in a stream of tokens."""
+
+    def __init__(self, stop_strs: Iterable[str] = (), stop_token_ids: Iterable[int] = ()):
+        self.stop_strs = list(stop_strs)
+        self.stop_token_ids = set(stop_token_ids)
+
+        # The trie of the stop strings. State 0 is the root, and
+        # match_lens[s] is the length of the longest stop string that ends at
+        # state s, or 0.
+        self.goto = [{}]
+        self.fail = [0]
+        self.match_lens = [0]
+        for stop_str in self.stop_strs:
+            state = 0
+            for ch in stop_str:
+                if ch not in self.goto[state]:
+                    self.goto[state][ch] = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.match_lens.append(0)
+                state = self.goto[state][ch]
+            self.match_lens[state] = len(stop_str)
+
+        # The failure link of a state is its longest proper suffix in the
+        # trie. States are visited in breadth-first order, so the links of
+        # shorter states are known.
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for ch, child in self.goto[state].items():
+                self.fail[child] = self.step(self.fail[state], ch) if state else 0
+                self.match_lens[child] = max(self.match_lens[child],
+                                             self.match_lens[self.fail[child]])
+                queue.append(child)
+
+        self.state = 0
+        self.text_len = 0
+
+    @classmethod
+    def from_params(cls, params, tokenizer):
+        stop_token_ids = list(params.get("stop_token_ids", None) or [])
+        if tokenizer.eos_token_id is not None:
+            stop_token_ids.append(tokenizer.eos_token_id)
+        return cls(get_stop_strs(params, tokenizer.eos_token), stop_token_ids)
+
+    def step(self, state, ch):
+        while state and ch not in self.goto[state]:
+            state = self.fail[state]
+        return self.goto[state].get(ch, 0)
+
+    def update(self, token_id: int, text: str) -> Optional[int]:
+        """Feed a new token and its text.
+
+        Return None to continue, or the length of the output to keep when the
+        generation must stop. The text of a stop token and the stop string
+        itself are not kept.
+        """
+        if token_id in self.stop_token_ids:
+            return self.text_len
+        for ch in text:
+            self.text_len += 1
+            self.state = self.step(self.state, ch)
+            if self.match_lens[self.state]:
+                return self.text_len - self.match_lens[self.state]
+        return None
@@ -0,0 +1,96 @@
+"""
+The wire protocol of `/worker_generate_stream`.
+
+A stream is a sequence of JSON frames, each followed by b"\\0".
+Two protocol versions exist and a client picks one with
+`params["stream_protocol"]`:
+
+- "full" (default): every frame carries the whole text so far, including
+  the echoed prompt, as `{"text": ..., "error_code": 0}`.
+- "delta": the prompt is not echoed and every frame carries only the new
+  text and token ids, as `{"text": ..., "token_ids": [...], "error_code": 0}`.
+  The last frame additionally has a non-null `finish_reason` and a `usage`
+  summary. Text that may be the beginning of a stop string is held back
+  until it is known not to be one, because sent text cannot be taken back.
+
+With `n` or `best_of` samples, the frames of all samples are interleaved
+in one stream and carry the `index` of their sample. In the "delta"
+version every sample has its own last frame.
+
+Error frames are the same in both versions: `{"text": ..., "error_code": n}`.
+"""
+import json
+from typing import List, Optional
+
+
+STREAM_PROTOCOL_FULL = "full"
+STREAM_PROTOCOL_DELTA = "delta"
+
+
+def encode_frame(ret):
+    return json.dumps(ret).encode() + b"\0"
+
+
+def iter_frames(response):
+    """Iterate over the decoded frames of a `requests` streaming response."""
+    for chunk in response.iter_lines(decode_unicode=False, delimiter=b"\0"):
+        if chunk:
+            yield json.loads(chunk.decode())
+
+
+def partial_stop_len(text: str, stop_strs: List[str]):
+    """Return the length of the longest suffix of text that starts a stop string."""
+    longest = 0
+    for stop_str in stop_strs:
+        for i in range(min(len(stop_str) - 1, len(text)), longest, -1):
+            if text.endswith(stop_str[:i]):
+                longest = i
+                break
+    return longest
+
+
+class DeltaEncoder:
+    """Turn the outputs of a generate function into delta frames.
+
+    The generate function must be called with `echo=False`, so that the text
+    of every output is the output so far without the prompt.
+    """
+
+    def __init__(self, stop_strs: Optional[List[str]] = None):
+        self.stop_strs = stop_strs or []
+        self.sent_len = 0
+        self.text = ""
+        self.token_ids = []
+        self.usage = None
+        self.finish_reason = None
+
+    def update(self, output):
+        """Return the frame for a new output, or None if there is nothing to send."""
+        self.text = output["text"]
+        self.token_ids.extend(output.get("token_ids", []))
+        self.usage = output.get("usage", self.usage)
+        self.finish_reason = output.get("finish_reason", None)
+        if self.finish_reason is not None:
+            return None
+
+        end = len(self.text) - partial_stop_len(self.text, self.stop_strs)
+        if end <= self.sent_len and not self.token_ids:
+            return None
+        return self.make_frame(max(end, self.sent_len))
+
+    def finish(self):
+        """Return the final frame with the remaining text and the summary."""
+        ret = self.make_frame(max(len(self.text), self.sent_len))
+        ret["finish_reason"] = self.finish_reason or "stop"
+        ret["usage"] = self.usage
+        return ret
+
+    def make_frame(self, end):
+        ret = {
+            "text": self.text[self.sent_len:end],
+            "token_ids": self.token_ids,
+            "error_code": 0,
+        }
+        self.sent_len = end
+        self.token_ids = []
+        return ret
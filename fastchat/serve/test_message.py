@@ -1,15 +1,15 @@
 import argparse
-import json
 
 import requests
 
 from fastchat.conversation import get_default_conv_template, SeparatorStyle
-from fastchat.serve.inference import compute_skip_echo_len
+from fastchat.serve.stream_protocol import STREAM_PROTOCOL_DELTA, iter_frames
 
 
 def main():
     model_name = args.model_name
 
+    dispatch_id = None
     if args.worker_address:
         worker_addr = args.worker_address
     else:
@@ -23,6 +23,7 @@ def main():
         ret = requests.post(controller_addr + "/get_worker_address",
             json={"model": model_name})
         worker_addr = ret.json()["address"]
+        dispatch_id = ret.json().get("dispatch_id", None)
         print(f"worker_addr: {worker_addr}")
 
     if worker_addr == "":
@@ -40,17 +41,21 @@ def main():
         "max_new_tokens": args.max_new_tokens,
         "temperature": args.temperature,
         "stop": conv.sep if conv.sep_style == SeparatorStyle.SINGLE else conv.sep2,
+        "stream_protocol": STREAM_PROTOCOL_DELTA,
     }
+    if dispatch_id:
+        pload["dispatch_id"] = dispatch_id
     response = requests.post(worker_addr + "/worker_generate_stream", headers=headers,
             json=pload, stream=True)
 
     print(f"{conv.roles[0]}: {args.message}")
-    for chunk in response.iter_lines(chunk_size=8192, decode_unicode=False, delimiter=b"\0"):
-        if chunk:
-            data = json.loads(chunk.decode("utf-8"))
-            skip_echo_len = compute_skip_echo_len(model_name, conv, prompt)
-            output = data["text"][skip_echo_len:].strip()
-            print(f"{conv.roles[1]}: {output}", end="\r")
+    output = ""
+    for data in iter_frames(response):
+        if data["error_code"] != 0:
+            print(f"error_code: {data['error_code']}, {data['text']}")
+            return
+        output += data["text"]
+        print(f"{conv.roles[1]}: {output.strip()}", end="\r")
     print("")
 
 
@@ -1,4 +1,10 @@
-"""Benchmarking script to test the throughput of serving workers."""
+"""Benchmarking script to test the throughput of serving workers.
+
+With the delta stream protocol, it also reports the time to first token and
+the inter-token latency of the requests. To see how long prefills stall the
+other streams, add requests with long prompts that arrive while the others
+are decoding, e.g. `--n-long-prompt 1 --long-prompt-words 1500`.
+"""
 import argparse
 import json
 
@@ -6,7 +12,8 @@ import requests
 import threading
 import time
 
-from fastchat.conversation import default_conversation
+from fastchat.conversation import get_default_conv_template
+from fastchat.serve.stream_protocol import STREAM_PROTOCOL_DELTA, iter_frames
 
 
 def main():
@@ -28,10 +35,14 @@ def main():
     if worker_addr == "":
         return
 
-    conv = default_conversation.copy()
+    conv = get_default_conv_template(args.model_name).copy()
     conv.append_message(conv.roles[0], "Tell me a story with more than 1000 words")
     prompt_template = conv.get_prompt()
     prompts = [prompt_template for _ in range(args.n_thread)]
+    conv = get_default_conv_template(args.model_name).copy()
+    conv.append_message(conv.roles[0], "Summarize the following text. " +
+                        " ".join(["lorem ipsum"] * (args.long_prompt_words // 2)))
+    prompts += [conv.get_prompt() for _ in range(args.n_long_prompt)]
 
     headers = {"User-Agent": "fastchat Client"}
     ploads = [{
@@ -40,30 +51,58 @@ def main():
         "max_new_tokens": args.max_new_tokens,
         "temperature": 0.0,
         # "stop": conv.sep,
+        "stream_protocol": args.stream_protocol,
     } for i in range(len(prompts))]
 
+    ttfts = [None] * len(prompts)
+    # The inter-token latency of the tokens after the first frame. A frame
+    # of n tokens that arrives t seconds after the previous one counts as n
+    # tokens with a latency of t / n.
+    itls = [[] for _ in prompts]
+
     def send_request(results, i):
+        if i >= args.n_thread:
+            time.sleep(args.long_prompt_delay)
         if args.test_dispatch:
             ret = requests.post(controller_addr + "/get_worker_address",
                                 json={"model": args.model_name})
             thread_worker_addr = ret.json()["address"]
+            dispatch_id = ret.json().get("dispatch_id", None)
+            if dispatch_id:
+                ploads[i]["dispatch_id"] = dispatch_id
         else:
             thread_worker_addr = worker_addr
         print(f"thread {i} goes to {thread_worker_addr}")
+        start = time.time()
         response = requests.post(thread_worker_addr + "/worker_generate_stream", headers=headers,
-                                 json=ploads[i], stream=False)
-        k = list(response.iter_lines(chunk_size=8192, decode_unicode=False, delimiter=b"\0"))
-        # print(k)
-        response_new_words = json.loads(k[-2].decode("utf-8"))["text"]
-        error_code = json.loads(k[-2].decode("utf-8"))["error_code"]
-        # print(f"=== Thread {i} ===, words: {1}, error code: {error_code}")
-        results[i] = len(response_new_words.split(" ")) - len(prompts[i].split(" "))
+                                 json=ploads[i], stream=True)
+        if args.stream_protocol == STREAM_PROTOCOL_DELTA:
+            response_new_words = ""
+            last = None
+            for data in iter_frames(response):
+                response_new_words += data["text"]
+                now = time.time()
+                num_tokens = len(data.get("token_ids", []))
+                if num_tokens and last is None:
+                    ttfts[i] = now - start
+                elif num_tokens:
+                    itls[i].extend([(now - last) / num_tokens] * num_tokens)
+                if num_tokens:
+                    last = now
+            results[i] = len(response_new_words.split(" "))
+        else:
+            k = list(response.iter_lines(chunk_size=8192, decode_unicode=False, delimiter=b"\0"))
+            # print(k)
+            response_new_words = json.loads(k[-2].decode("utf-8"))["text"]
+            error_code = json.loads(k[-2].decode("utf-8"))["error_code"]
+            # print(f"=== Thread {i} ===, words: {1}, error code: {error_code}")
+            results[i] = len(response_new_words.split(" ")) - len(prompts[i].split(" "))
 
     # use N threads to prompt the backend
     tik = time.time()
     threads = []
-    results = [None] * args.n_thread
-    for i in range(args.n_thread):
+    results = [None] * len(prompts)
+    for i in range(len(prompts)):
         t = threading.Thread(target=send_request, args=(results, i))
         t.start()
         # time.sleep(0.5)
@@ -86,6 +125,29 @@ def main():
     print(f"Time (Completion): {time_seconds}, n threads: {args.n_thread}, "
           f"throughput: {n_words / time_seconds} words/s.")
 
+    if args.stream_protocol == STREAM_PROTOCOL_DELTA:
+        # The latency of the short requests, which the long prompts may stall.
+        print_latency("short", ttfts[:args.n_thread], sum(itls[:args.n_thread], []))
+        if args.n_long_prompt:
+            print_latency("long", ttfts[args.n_thread:], sum(itls[args.n_thread:], []))
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+def print_latency(name, ttfts, itls):
+    ttfts = [x for x in ttfts if x is not None]
+    if not ttfts or not itls:
+        return
+    print(f"[{name} prompts] "
+          f"TTFT p50: {percentile(ttfts, 50) * 1e3:.1f} ms, "
+          f"p99: {percentile(ttfts, 99) * 1e3:.1f} ms. "
+          f"Inter-token latency p50: {percentile(itls, 50) * 1e3:.1f} ms, "
+          f"p99: {percentile(itls, 99) * 1e3:.1f} ms, "
+          f"max: {max(itls) * 1e3:.1f} ms.")
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -95,6 +157,13 @@ if __name__ == "__main__":
     parser.add_argument("--max-new-tokens", type=int, default=2048)
     parser.add_argument("--n-thread", type=int, default=8)
     parser.add_argument("--test-dispatch", action="store_true")
+    parser.add_argument("--n-long-prompt", type=int, default=0,
+        help="The number of additional requests with a long prompt.")
+    parser.add_argument("--long-prompt-words", type=int, default=1500)
+    parser.add_argument("--long-prompt-delay", type=float, default=1.0,
+        help="Send the long prompts this many seconds after the others.")
+    parser.add_argument("--stream-protocol", type=str, default=STREAM_PROTOCOL_DELTA,
+        choices=["full", "delta"])
     args = parser.parse_args()
 
     main()